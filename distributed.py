@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# (C) British Crown Copyright 2015, Met Office
+#
+# This file is part of Tehuti.
+#
+# Tehuti is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tehuti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Tehuti.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Run tehuti metrics for many commits across several worker nodes.
+
+A coordinator splits the work into one job per (commit, metric) and queues
+the jobs as files in a directory shared by all the nodes. Each node claims
+jobs by atomically moving them out of the queue, runs them in a worktree of
+the job's commit, and writes back the result along with the fingerprint of
+its host. The coordinator merges the results into the tehuti results store
+as they arrive.
+
+The queue directory contains:
+
+* ``jobs/``: jobs waiting to be claimed.
+* ``claimed/``: jobs that a node is running. The node touches the job
+  file while it runs, and the coordinator puts jobs whose files have not
+  been touched for a while back in the queue, in case their node died.
+* ``results/``: results waiting to be merged by the coordinator.
+* ``closed``: created once all jobs are queued, so that idle nodes exit.
+
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from tehuti import (Results, Worker, Worktree, atomic_write, metric_ids, sha,
+                    shorten_sha)
+
+
+#: The path of this script, used to start local nodes.
+DISTRIBUTED = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+def _claim(queue_dir, commit=None):
+    """
+    Claim a job from the queue, preferring jobs for ``commit``.
+
+    Returns:
+        The claimed job, or None if the queue is empty.
+
+    """
+    names = sorted(name for name in os.listdir(os.path.join(queue_dir, 'jobs'))
+                   if name.endswith('.json'))
+    names.sort(key=lambda name: not name.startswith(str(commit)))
+    for name in names:
+        claimed = os.path.join(queue_dir, 'claimed', name)
+        try:
+            os.rename(os.path.join(queue_dir, 'jobs', name), claimed)
+        except OSError:
+            # Another node got there first.
+            continue
+        # Renaming keeps the time the job was queued, so mark it as live.
+        os.utime(claimed, None)
+        with open(claimed) as f:
+            job = json.load(f)
+        job['job'] = name
+        return job
+
+
+def _heartbeat(path, done, interval):
+    """Touch ``path`` every ``interval`` seconds until ``done`` is set."""
+    while not done.wait(interval):
+        try:
+            os.utime(path, None)
+        except OSError:
+            # The job was requeued.
+            return
+
+
+def _requeue_stale(queue_dir, timeout):
+    """
+    Move claimed jobs that have not been touched for ``timeout`` seconds
+    back into the queue.
+
+    """
+    now = time.time()
+    for name in os.listdir(os.path.join(queue_dir, 'claimed')):
+        claimed = os.path.join(queue_dir, 'claimed', name)
+        try:
+            if now - os.path.getmtime(claimed) > timeout:
+                os.rename(claimed, os.path.join(queue_dir, 'jobs', name))
+                print 'Requeued {}, its node stopped responding'.format(name)
+        except OSError:
+            # The job finished in the meantime.
+            continue
+
+
+def node(metrics_module_name, queue_dir, poll=1.0):
+    """
+    Run jobs from the queue until it is closed and empty.
+
+    Jobs are run by a :class:`tehuti.Worker` in a :class:`tehuti.Worktree` of
+    the job's commit, both of which are kept for as long as there are jobs
+    for the same commit. The commits must be available in the repository in
+    the current working directory.
+
+    Args:
+
+    * metrics_module_name:
+        The importable name of the metrics module.
+    * queue_dir:
+        The queue directory shared with the coordinator.
+
+    Kwargs:
+
+    * poll:
+        The number of seconds to wait between checks of an empty queue.
+
+    """
+    commit = worktree = worker = None
+    try:
+        while True:
+            job = _claim(queue_dir, commit)
+            if job is None:
+                if os.path.exists(os.path.join(queue_dir, 'closed')):
+                    break
+                time.sleep(poll)
+                continue
+            if job['commit'] != commit:
+                if worktree is not None:
+                    worker.close()
+                    worktree.__exit__(None, None, None)
+                commit = job['commit']
+                worktree = Worktree(commit)
+                worker = Worker(metrics_module_name, worktree.__enter__())
+            result = {'commit': commit, 'id': job['id'],
+                      'name': worker.info['name'],
+                      'host': worker.info['host']}
+            claimed = os.path.join(queue_dir, 'claimed', job['job'])
+            done = threading.Event()
+            heartbeat = threading.Thread(target=_heartbeat,
+                                         args=(claimed, done, poll))
+            heartbeat.daemon = True
+            heartbeat.start()
+            start = time.time()
+            try:
+                result['result'] = worker.run(job['id'])
+            except RuntimeError as error:
+                result['error'] = str(error)
+            finally:
+                done.set()
+            result['duration'] = time.time() - start
+            atomic_write(os.path.join(queue_dir, 'results', job['job']),
+                         json.dumps(result))
+            try:
+                os.remove(claimed)
+            except OSError:
+                # The job was requeued while it ran.
+                pass
+    finally:
+        if worktree is not None:
+            worker.close()
+            worktree.__exit__(None, None, None)
+
+
+def coordinate(metrics_module_name, commits, queue_dir=None, workers=0,
+               single_id=None, force=False, poll=1.0, timeout=60.0):
+    """
+    Queue a job for each metric of each commit that doesn't already have a
+    result, then merge results into the results store as nodes return them.
+
+    Args:
+
+    * metrics_module_name:
+        The importable name of the metrics module.
+    * commits:
+        The names of the commits to measure.
+
+    Kwargs:
+
+    * queue_dir:
+        The queue directory, which must be shared with any nodes on other
+        hosts. Defaults to a new temporary directory, which is removed
+        afterwards.
+    * workers:
+        The number of nodes to start on this host. Nodes on other hosts are
+        started separately with :func:`node`.
+    * single_id:
+        The ID of a single metric to run.
+    * force:
+        Whether to re-run metrics that already have results.
+    * poll:
+        The number of seconds to wait between checks for results.
+    * timeout:
+        The number of seconds after which a job whose node has stopped
+        touching it is put back in the queue.
+
+    """
+    remove_queue = queue_dir is None
+    if queue_dir is None:
+        queue_dir = tempfile.mkdtemp(prefix='tehuti-queue-')
+    for name in ('jobs', 'claimed', 'results'):
+        if not os.path.isdir(os.path.join(queue_dir, name)):
+            os.makedirs(os.path.join(queue_dir, name))
+    closed = os.path.join(queue_dir, 'closed')
+    if os.path.exists(closed):
+        os.remove(closed)
+
+    ids = metric_ids(metrics_module_name)
+    if single_id is not None:
+        ids = [single_id]
+    results = Results.load(metrics_module_name)
+    pending = set()
+    for commit in commits:
+        commit = sha(commit)
+        for metric_id in ids:
+            if not force and metric_id in results.results.get(commit, {}):
+                continue
+            name = '{}-{}.json'.format(commit,
+                                       hashlib.sha1(metric_id).hexdigest())
+            atomic_write(os.path.join(queue_dir, 'jobs', name),
+                         json.dumps({'commit': commit, 'id': metric_id}))
+            pending.add(name)
+    open(closed, 'w').close()
+    print 'Queued {} jobs in {}'.format(len(pending), queue_dir)
+
+    nodes = [subprocess.Popen([sys.executable, DISTRIBUTED, 'node',
+                               metrics_module_name, queue_dir])
+             for _ in range(workers)]
+    try:
+        while pending:
+            names = pending.intersection(
+                os.listdir(os.path.join(queue_dir, 'results')))
+            if not names:
+                if nodes and all(n.poll() is not None for n in nodes):
+                    raise RuntimeError('All local nodes exited with {} jobs '
+                                       'outstanding.'.format(len(pending)))
+                _requeue_stale(queue_dir, timeout)
+                time.sleep(poll)
+                continue
+            for name in names:
+                path = os.path.join(queue_dir, 'results', name)
+                with open(path) as f:
+                    result = json.load(f)
+                os.remove(path)
+                pending.remove(name)
+                commit, metric_id = result['commit'], result['id']
+                host = result['host']
+                if 'error' in result:
+                    print '{} @ {} failed on {}:\n{}'.format(
+                        metric_id, shorten_sha(commit), host['hostname'],
+                        result['error'])
+                    continue
+                entry = results.results.setdefault(
+                    commit, {'name': result['name'], 'host': host})
+                entry[metric_id] = result['result']
+                entry.setdefault('durations', {})[metric_id] = \
+                    result['duration']
+                if entry.get('host', {}).get('id') != host['id']:
+                    entry.setdefault('hosts', {})[metric_id] = host
+                else:
+                    entry.get('hosts', {}).pop(metric_id, None)
+                print '{} @ {} done on {}'.format(
+                    metric_id, shorten_sha(commit), host['hostname'])
+    finally:
+        results.save(metrics_module_name)
+        for process in nodes:
+            process.wait()
+        if remove_queue:
+            shutil.rmtree(queue_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    coordinate_parser = subparsers.add_parser(
+        'coordinate', help='queue jobs and collect their results')
+    coordinate_parser.add_argument('metrics_module')
+    coordinate_parser.add_argument('commits', nargs='+')
+    coordinate_parser.add_argument('-q', '--queue',
+                                   help='the shared queue directory')
+    coordinate_parser.add_argument('-w', '--workers', type=int, default=0,
+                                   help='the number of nodes to start on '
+                                        'this host')
+    coordinate_parser.add_argument('-i', '--id',
+                                   help='select a single metric by ID')
+    coordinate_parser.add_argument('-f', '--force', action='store_true')
+    coordinate_parser.add_argument('--timeout', type=float, default=60.0,
+                                   help='requeue jobs whose node has been '
+                                        'silent for this many seconds')
+    node_parser = subparsers.add_parser(
+        'node', help='run jobs from a queue')
+    node_parser.add_argument('metrics_module')
+    node_parser.add_argument('queue')
+    options = parser.parse_args()
+
+    if options.command == 'coordinate':
+        coordinate(options.metrics_module, options.commits, options.queue,
+                   options.workers, options.id, options.force,
+                   timeout=options.timeout)
+    else:
+        node(options.metrics_module, options.queue)
@@ -16,15 +16,25 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with Tehuti.  If not, see <http://www.gnu.org/licenses/>.
 import argparse
+import cgi
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import warnings
 
-from tehuti import Results
+import matplotlib.pyplot as plt
+
+from tehuti import CommitIndex, Results, date_option
 from vis_methods import VaryRepoCommit, Violin, ManyBenchmarks, VarySetup
 
 
 class Vis(object):
     """Provides functionality to visualise tehuti metrics results."""
 
-    def __init__(self, results, method):
+    def __init__(self, results, method, output_path=None, lod_threshold=500):
         """
         Construct a tehuti metrics visualiser.
 
@@ -44,9 +54,20 @@ class Vis(object):
                 * 'violin': plot benchmark results as a violin plot.
                 * 'many': plot multiple benchmarks on a single plot.
 
+        Kwargs:
+
+        * output_path: (str)
+            If given, plots are saved to this file rather than shown.
+        * lod_threshold: (int)
+            Plots of results against more commits than this are downsampled
+            to about this many points, keeping change points and extremes.
+            Set to 0 to always plot every commit.
+
         """
         self.results = results
         self._method = method
+        self.output_path = output_path
+        self.lod_threshold = lod_threshold
         self.plot_data = None
 
         self.methods = {'basic': VaryRepoCommit(self),
@@ -102,6 +123,121 @@ class Vis(object):
             self.select_data()
         self.method.plot(alternate_plot)
 
+    def show(self):
+        """
+        Show the current figure, or save it to `output_path` if set.
+
+        """
+        if self.output_path is None:
+            plt.show()
+        else:
+            plt.savefig(self.output_path)
+            plt.close()
+
+
+def _figures(method, alternate, plot_data):
+    """
+    Split plot data into the data of each figure that the state `method`
+    plots, as a list of (name, data) pairs.
+
+    """
+    one_type = len(set(name.split('-')[0] for name in plot_data)) == 1
+    if alternate and method != 'violin' and (method != 'basic' or one_type):
+        return [('all', plot_data)]
+    if method == 'setup':
+        return [('{}-{}'.format(b, commit), {b: {commit: results}})
+                for b, inter in plot_data.iteritems()
+                for commit, results in inter.iteritems()]
+    return [(name, {name: results})
+            for name, results in plot_data.iteritems()]
+
+
+def _render(job):
+    method, alternate, plot_data, path, lod_threshold = job
+    visualiser = Vis(None, method, output_path=path,
+                     lod_threshold=lod_threshold)
+    visualiser.plot_data = plot_data
+    visualiser.plot(alternate)
+
+
+def render(visualiser, alternate, plotstyle, output_dir, processes=None):
+    """
+    Save every figure of the visualiser's plot data to an image in
+    `output_dir`, and write an `index.html` page showing all the figures
+    saved to the directory so far, by plot style.
+
+    Figures are rendered across a pool of processes. A figure is only
+    re-rendered if its data has changed since it was last rendered into the
+    same directory.
+
+    Args:
+
+    * visualiser: (:class:`Vis`)
+        The visualiser, with data selected.
+    * alternate: (bool)
+        Whether to use the alternate plotting mode of the state.
+    * plotstyle: (str)
+        The name of the plot style, used to name the images.
+    * output_dir: (str)
+        The directory to write to.
+
+    Kwargs:
+
+    * processes: (int)
+        The number of processes to render with. Defaults to the number of
+        CPUs.
+
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    manifest_path = os.path.join(output_dir, 'index.json')
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+    method = visualiser._method
+    figures = _figures(method, alternate, visualiser.plot_data)
+    jobs = []
+    for name, plot_data in figures:
+        filename = '{}-{}.png'.format(plotstyle,
+                                      re.sub(r'[^\w.-]', '_', name))
+        data_hash = hashlib.sha1(json.dumps([plotstyle,
+                                             visualiser.lod_threshold,
+                                             plot_data])).hexdigest()
+        if (manifest.get(filename, {}).get('hash') != data_hash or
+                not os.path.exists(os.path.join(output_dir, filename))):
+            jobs.append((method, alternate, plot_data,
+                         os.path.join(output_dir, filename),
+                         visualiser.lod_threshold))
+            manifest[filename] = {'hash': data_hash, 'name': name,
+                                  'plotstyle': plotstyle}
+    print 'Rendering {} of {} figures'.format(len(jobs), len(figures))
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_render, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    with open(os.path.join(output_dir, 'index.html'), 'w') as f:
+        f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                '<title>Tehuti metrics</title></head>\n<body>\n')
+        style = None
+        for filename, figure in sorted(manifest.items(),
+                                       key=lambda item: (
+                                           item[1]['plotstyle'],
+                                           item[1]['name'])):
+            if figure['plotstyle'] != style:
+                style = figure['plotstyle']
+                f.write('<h1>{}</h1>\n'.format(cgi.escape(style)))
+            f.write('<h2 id="{0}">{1}</h2>\n<a href="{0}"><img src="{0}" '
+                    'alt="{1}"></a>\n'.format(cgi.escape(filename, True),
+                                               cgi.escape(figure['name'])))
+        f.write('</body></html>\n')
+
 
 if __name__ == '__main__':
     choices = ['basic', 'violin', 'many', 'setup',
@@ -114,15 +250,69 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--metrics', default=None, nargs='+',
                         help='select metrics to visualise by ID')
     parser.add_argument('-c', '--commits', nargs='+', default=None)
+    parser.add_argument('--host',
+                        help='only plot results from this host name or ID')
+    parser.add_argument('--normalise', metavar='HOST',
+                        help='normalise timings to the speed of this host')
+    parser.add_argument('--since', type=date_option, metavar='YYYY-MM-DD',
+                        help='only plot commits authored since this date')
+    parser.add_argument('--branch',
+                        help='only plot commits reachable from this one')
+    parser.add_argument('--env', nargs='+', metavar='NAME',
+                        help='only plot commits run in these environments '
+                             'by the matrix command, whose results are '
+                             'plotted as metrics named ID@NAME')
+    parser.add_argument('-o', '--output', metavar='DIR',
+                        help='save all plots to DIR, with an HTML index, '
+                             'instead of showing them')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='the number of processes to save plots with')
+    parser.add_argument('--lod', type=int, default=500, metavar='N',
+                        help='downsample plots of more than N commits to '
+                             'about N points (default: %(default)s, '
+                             '0 disables)')
     options = parser.parse_args()
-    module = __import__(options.module).metrics
-    results = Results.load(options.module).results
+    if options.output is not None:
+        plt.switch_backend('Agg')
+    # Only read the results that will be plotted, including those of the
+    # environments of metrics named ID@NAME.
+    metrics = options.metrics
+    if metrics is not None:
+        metrics = metrics + [metric.rsplit('@', 1)[0] for metric in metrics]
+    results = Results.load(options.module, options.commits, metrics)
+    if options.normalise is not None:
+        # The reference host may only have results of other commits, so
+        # find its calibration from the metadata of all of them.
+        hosts = results
+        if results.partial:
+            hosts = Results.load(options.module, metrics=[])
+        results = results.normalise(
+            options.normalise, hosts.calibration(options.normalise))
+    if options.host is not None:
+        results = results.select_host(options.host)
+    results = results.fold_environments(options.env).results
+    # Plot commits in order, parents first, if run in the repository.
+    commits = options.commits
+    try:
+        index = CommitIndex.load()
+    except (OSError, subprocess.CalledProcessError):
+        if options.since is not None or options.branch is not None:
+            raise ValueError('--since and --branch must be used in the '
+                             'repository of the results.')
+        warnings.warn('Not in a git repository, commits are not ordered.')
+    else:
+        commits = index.select(commits or results.keys(), options.since,
+                               options.branch)
     try:
         method, alternate = options.plotstyle.split('-')
     except ValueError:
         method, alternate = options.plotstyle, False
     else:
         alternate = True
-    visualiser = Vis(results, method)
-    visualiser.select_data(options.commits, options.metrics)
-    visualiser.plot(alternate)
+    visualiser = Vis(results, method, lod_threshold=options.lod)
+    visualiser.select_data(commits, options.metrics)
+    if options.output is not None:
+        render(visualiser, alternate, options.plotstyle, options.output,
+               options.jobs)
+    else:
+        visualiser.plot(alternate)
@@ -15,17 +15,44 @@
 #
 # You should have received a copy of the GNU Lesser General Public License
 # along with Tehuti.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+
 from abc import ABCMeta, abstractmethod
 import argparse
+import ast
+import cProfile
+import fnmatch
+import glob
+import hashlib
 import importlib
 import json
+import multiprocessing
 import os
+import pkgutil
+import platform
+import pstats
+import re
+import shlex
+import shutil
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import timeit
+import traceback
+import urllib
 import warnings
 
-import numpy as np
+# Metrics run in workers under the Python of each environment of the
+# ``matrix`` command, which may be Python 3.
+try:
+    string_types = basestring
+    range_type = xrange
+except NameError:
+    string_types = str
+    range_type = range
 
 
 class Metric(object):
@@ -40,6 +67,36 @@ class Metric(object):
         pass
 
 
+def _load_cache(name):
+    """Returns the named cache of metric results of files, from PKL_DIR."""
+    try:
+        with open(os.path.join(PKL_DIR, name + '-cache.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def atomic_write(path, text):
+    """
+    Replace the file ``path`` with ``text`` atomically, by writing to a
+    temporary file alongside it first, so that readers in other processes
+    never see a partial file.
+
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.rename(tmp_path, path)
+
+
+def _save_cache(name, cache):
+    if not os.path.isdir(PKL_DIR):
+        os.makedirs(PKL_DIR)
+    # Workers may share the cache.
+    atomic_write(os.path.join(PKL_DIR, name + '-cache.json'),
+                 json.dumps(cache))
+
+
 class TimeMetric(Metric):
     class Context(object):
         pass
@@ -52,7 +109,7 @@ class TimeMetric(Metric):
         self.name = name
 
     def id(self):
-        return 'timeit-{}'.format(self.name or self.body.func_name)
+        return 'timeit-{}'.format(self.name or self.body.__name__)
 
     def run(self):
         context = TimeMetric.Context()
@@ -67,46 +124,273 @@ class TimeMetric(Metric):
 
 
 class LineCountMetric(Metric):
-    def __init__(self, path):
+    """
+    Counts the lines of the files matching a path or glob pattern, such as
+    ``'lib/*.py'``, where ``*`` also matches across directories.
+
+    Lines are counted in-process, and the counts of files committed to git
+    are cached by their blob hash, so only new and changed files are read.
+    If no file known to git matches, such as for ignored files or paths
+    outside the repository, files are found with :func:`glob.glob` instead.
+    The result is a dictionary of the ``'total'`` count, the ``'breakdown'``
+    of counts by directory and, if ``kinds`` is set, the split of the total
+    into ``'code'``, ``'comment'`` and ``'blank'`` lines.
+
+    """
+    #: The line prefixes of comments, by file extension.
+    COMMENT_PREFIXES = {'.py': ('#',), '.pyx': ('#',), '.sh': ('#',),
+                        '.cfg': ('#', ';'), '.c': ('//',), '.h': ('//',),
+                        '.cpp': ('//',), '.f90': ('!',)}
+
+    #: The start and end of block comments, by file extension. Every line
+    #: from one starting a block comment to the one ending it is a comment.
+    BLOCK_COMMENTS = {'.c': ('/*', '*/'), '.h': ('/*', '*/'),
+                      '.cpp': ('/*', '*/')}
+
+    def __init__(self, path, kinds=False):
         self.path = path
+        self.kinds = kinds
 
     def id(self):
         return 'linecount-{}'.format(self.path)
 
+    @staticmethod
+    def _files():
+        """
+        Returns the git blob hash of each file in the working tree, or None
+        for untracked and modified files, which have no committed blob.
+
+        """
+        try:
+            with open(os.devnull, 'w') as devnull:
+                output = subprocess.check_output(
+                    ['git', 'ls-files', '-s', '-z'], stderr=devnull,
+                    universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            return {}
+        files = {}
+        for record in output.split('\0'):
+            if record:
+                info, path = record.split('\t', 1)
+                files[path] = info.split()[1]
+        output = subprocess.check_output(['git', 'ls-files', '-z', '-m', '-o',
+                                          '--exclude-standard'],
+                                         universal_newlines=True)
+        files.update((path, None) for path in output.split('\0') if path)
+        return files
+
+    def _count(self, path):
+        """Returns [lines] or, with kinds, [lines, code, comment, blank]."""
+        with open(path, 'rb') as f:
+            if not self.kinds:
+                lines = 0
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    lines += chunk.count(b'\n')
+                return [lines]
+            text = f.read()
+        lines = text.count(b'\n')
+        extension = os.path.splitext(path)[1]
+        prefixes = tuple(prefix.encode('ascii') for prefix in
+                         self.COMMENT_PREFIXES.get(extension, ()))
+        start, end = [marker.encode('ascii') for marker in
+                      self.BLOCK_COMMENTS.get(extension, ('', ''))]
+        code = comment = blank = 0
+        in_block = False
+        for line in text.split(b'\n', lines)[:lines]:
+            line = line.strip()
+            if not line:
+                blank += 1
+            elif in_block:
+                comment += 1
+                in_block = end not in line
+            elif prefixes and line.startswith(prefixes):
+                comment += 1
+            elif start and line.startswith(start):
+                comment += 1
+                in_block = end not in line[len(start):]
+            else:
+                code += 1
+                # A block comment may start after some code.
+                in_block = (bool(start) and start in line and
+                            line.rfind(start) > line.rfind(end))
+        return [lines, code, comment, blank]
+
     def run(self):
-        count, _ = subprocess.check_output(['wc', '-l', self.path]).split()
-        return int(count)
+        # git lists paths relative to the current directory.
+        pattern = os.path.relpath(self.path)
+        files = self._files()
+        paths = sorted(path for path in files
+                       if fnmatch.fnmatch(path, pattern) and
+                       os.path.isfile(path))
+        if not paths:
+            # Not in a git repository, or the files are outside it or
+            # ignored by git.
+            paths = sorted(path for path in glob.glob(pattern)
+                           if os.path.isfile(path))
+        if not paths:
+            raise ValueError('No files match {!r}.'.format(self.path))
+        cache = _load_cache('linecount')
+        size = 4 if self.kinds else 1
+        changed = False
+        total = [0] * size
+        breakdown = {}
+        for path in paths:
+            blob = files.get(path)
+            key = '{} {}'.format(blob, os.path.splitext(path)[1])
+            counts = cache.get(key) if blob else None
+            if counts is None or len(counts) < size:
+                counts = self._count(path)
+                if blob:
+                    cache[key] = counts
+                    changed = True
+            directory = os.path.dirname(path) or '.'
+            breakdown[directory] = breakdown.get(directory, 0) + counts[0]
+            total = [t + c for t, c in zip(total, counts)]
+        if changed:
+            _save_cache('linecount', cache)
+        result = {'total': total[0], 'breakdown': breakdown}
+        if self.kinds:
+            result['kinds'] = dict(zip(['code', 'comment', 'blank'],
+                                       total[1:]))
+        return result
+
+
+def _pylint_stats(args):
+    """
+    Lint one module with pylint, in-process, and return the number of
+    statements and of messages of each category.
+
+    """
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    from pylint.lint import Run
+    from pylint.reporters.text import TextReporter
+    module, rcfile = args
+    # Turn off production of the import graph.
+    command = ['--disable=RP0402', '--persistent=n', module]
+    if rcfile is not None:
+        command.insert(0, '--rcfile={}'.format(rcfile))
+    stats = Run(command, reporter=TextReporter(StringIO()),
+                exit=False).linter.stats
+    if isinstance(stats, dict):
+        get = stats.get
+    else:
+        # Pylint 2.12 and later keep stats in a LinterStats object.
+        get = lambda key, default: getattr(stats, key, default)
+    return {key: get(key, 0) or 0 for key in PylintMetric.STATS}
 
 
 class PylintMetric(Metric):
-    def __init__(self, module):
-        self.module = module
+    """
+    Lints one or more modules with pylint, given as file or module names.
+
+    The modules are linted in parallel by a pool of processes using the
+    pylint API. The statistics of each module are cached by a hash of its
+    source, the pylint configuration and the pylint version, so only
+    changed modules are linted again.
+
+    The result is a dictionary of the ``'total'`` score of all the modules,
+    the ``'breakdown'`` of scores by module and the number of
+    ``'messages'`` in each category. Scores are computed with pylint's
+    default evaluation.
+
+    """
+    #: The statistics of each module that are cached.
+    STATS = ('statement', 'fatal', 'error', 'warning', 'refactor',
+             'convention', 'info')
+
+    def __init__(self, modules, name=None, rcfile=None, jobs=None):
+        if isinstance(modules, string_types):
+            modules = [modules]
+        self.modules = list(modules)
+        self.name = name
+        self.rcfile = rcfile
+        self.jobs = jobs
 
     def id(self):
-        return 'pylint-{}'.format(self.module)
+        return 'pylint-{}'.format(self.name or ','.join(self.modules))
+
+    @staticmethod
+    def score(stats):
+        """Returns the score of the given statistics."""
+        if stats['fatal'] or not stats['statement']:
+            return 0.0
+        penalty = (5 * stats['error'] + stats['warning'] + stats['refactor'] +
+                   stats['convention'])
+        return 10.0 - float(penalty) / stats['statement'] * 10
+
+    @staticmethod
+    def _sources(module):
+        """Returns the source files of a module, or None if not found."""
+        path = module
+        if not os.path.exists(path):
+            path = module.replace('.', os.sep)
+            if not os.path.isdir(path):
+                path += '.py'
+        if os.path.isfile(path):
+            return [path]
+        if os.path.isdir(path):
+            return sorted(os.path.join(root, name)
+                          for root, _, names in os.walk(path)
+                          for name in names if name.endswith('.py'))
+
+    def _config_hash(self):
+        import pylint
+        config = hashlib.sha1(pylint.__version__.encode('ascii'))
+        rcfile = self.rcfile
+        if rcfile is None:
+            rcfile = os.environ.get('PYLINTRC', 'pylintrc')
+        for path in (rcfile, '.pylintrc'):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    config.update(f.read())
+                break
+        return config.hexdigest()
 
     def run(self):
-        # Turn off production of the import graph.
-        cmd = ['pylint', '--disable=RP0402']
-        pylint = subprocess.Popen(cmd + [self.module], stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE)
-        output, _ = pylint.communicate()
-        # Pylint error codes 1 (fatal error) and 32 (user error) indicate a
-        # failed run.
-        if pylint.returncode not in [1, 32]:
-            output = output.split('\n')
-            rating = [line for line in output
-                      if 'code has been rated at' in line]
-            rating = float(rating[0].split()[6].split('/')[0])
+        cache = _load_cache('pylint')
+        config = self._config_hash()
+        keys = {}
+        for module in self.modules:
+            sources = self._sources(module)
+            if sources is not None:
+                key = hashlib.sha1(config.encode('ascii'))
+                for path in sources:
+                    with open(path, 'rb') as f:
+                        key.update(f.read())
+                keys[module] = key.hexdigest()
+        todo = [module for module in self.modules
+                if keys.get(module) not in cache]
+        if len(todo) > 1:
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                linted = pool.map(_pylint_stats,
+                                  [(module, self.rcfile) for module in todo])
+            finally:
+                pool.close()
+                pool.join()
         else:
-            # Possibly this should raise some sort of metric-failure
-            # error, or just return a failure token which can be recorded
-            # in the results cache.
-            msg = 'Pylint process failed with error code {}, defaulting code '\
-                  'rating to 0.'
-            warnings.warn(msg.format(pylint.returncode))
-            rating = 0
-        return rating
+            linted = [_pylint_stats((module, self.rcfile)) for module in todo]
+        linted = dict(zip(todo, linted))
+        for module, stats in linted.items():
+            if module in keys:
+                cache[keys[module]] = stats
+        if any(module in keys for module in todo):
+            _save_cache('pylint', cache)
+
+        total = dict.fromkeys(self.STATS, 0)
+        breakdown = {}
+        for module in self.modules:
+            stats = linted.get(module) or cache[keys[module]]
+            breakdown[module] = self.score(stats)
+            for key in self.STATS:
+                total[key] += stats[key]
+        messages = {key: total[key] for key in self.STATS
+                    if key != 'statement'}
+        return {'total': self.score(total), 'breakdown': breakdown,
+                'messages': messages}
 
 
 class MemoryMetric(object):
@@ -137,7 +421,7 @@ class MemoryMetric(object):
         return self._usage_log
 
     def id(self):
-        return 'memoryuse-{}'.format(self.name or self.body.func_name)
+        return 'memoryuse-{}'.format(self.name or self.body.__name__)
 
     def _outer(self, setup, func):
         def _inner(_func=func):
@@ -164,6 +448,7 @@ class MemoryMetric(object):
         self.usage_log.append(self._metrics)
 
     def run(self):
+        self._usage_log = []
         context = MemoryMetric.Context()
         if self.setup is not None:
             setup = lambda: self.setup(context)
@@ -188,9 +473,10 @@ class RMSErrorMetric(Metric):
         self.log = []
 
     def id(self):
-        return 'accuracy-{}'.format(self.name or self.body.func_name)
+        return 'accuracy-{}'.format(self.name or self.body.__name__)
 
     def run(self):
+        import numpy as np
         context = RMSErrorMetric.Context()
         if self.setup is not None:
             self.setup(context)
@@ -200,15 +486,240 @@ class RMSErrorMetric(Metric):
         return rms
 
 
+class ImportTimeMetric(Metric):
+    """
+    Times importing a module in fresh interpreters, using the
+    ``-X importtime`` option of Python 3.7 and later.
+
+    The result is a dictionary of the ``'total'`` import time of each run,
+    in seconds, and the median cumulative (``'breakdown'``) and ``'self'``
+    times of the ``top`` modules that took longest to import by themselves.
+
+    """
+    #: Written to stderr just before the import, to separate the imports of
+    #: interpreter start-up from those of the module.
+    MARKER = 'tehuti-import-start'
+
+    def __init__(self, module, repeat=10, top=20, python=None):
+        self.module = module
+        self.repeat = repeat
+        self.top = top
+        self.python = python
+
+    def id(self):
+        return 'importtime-{}'.format(self.module)
+
+    def _check_python(self):
+        """Raise ValueError if the interpreter has no ``-X importtime``."""
+        python = self.python or sys.executable
+        version = ast.literal_eval(subprocess.check_output(
+            [python, '-c', 'import sys; print(tuple(sys.version_info[:2]))'],
+            universal_newlines=True).strip())
+        if version < (3, 7):
+            msg = ('-X importtime needs Python 3.7 or later, but {} is '
+                   'Python {}.{}; pass the python of a newer interpreter.')
+            raise ValueError(msg.format(python, *version))
+
+    def _times(self):
+        """
+        Import the module in a new interpreter and return the
+        ``(name, self, cumulative, top_level)`` times of each module
+        imported, in seconds.
+
+        """
+        code = 'import sys; sys.stderr.write({!r}); import {}'.format(
+            self.MARKER + '\n', self.module)
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(
+                [self.python or sys.executable, '-X', 'importtime', '-c',
+                 code], stdout=devnull, stderr=subprocess.PIPE,
+                universal_newlines=True)
+            _, output = process.communicate()
+        if process.returncode:
+            raise RuntimeError('Importing {} failed:\n{}'.format(self.module,
+                                                                  output))
+        output = output.split(self.MARKER + '\n', 1)[1]
+        rows = []
+        for line in output.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            self_time, cumulative, name = line[12:].split('|')
+            if not self_time.strip().isdigit():
+                # The header row.
+                continue
+            rows.append((name.strip(), int(self_time) * 1e-6,
+                         int(cumulative) * 1e-6,
+                         len(name) - len(name.lstrip())))
+        if not rows:
+            raise ValueError('No import times reported.')
+        depth = min(row[3] for row in rows)
+        return [(name, self_time, cumulative, indent == depth)
+                for name, self_time, cumulative, indent in rows]
+
+    def run(self):
+        import numpy as np
+        self._check_python()
+        totals = []
+        self_times = {}
+        cumulative_times = {}
+        for _ in range(self.repeat):
+            times = self._times()
+            totals.append(sum(cumulative for _, _, cumulative, top_level
+                              in times if top_level))
+            for name, self_time, cumulative, _ in times:
+                self_times.setdefault(name, []).append(self_time)
+                cumulative_times.setdefault(name, []).append(cumulative)
+        self_times = {name: float(np.median(values))
+                      for name, values in self_times.items()}
+        top = sorted(self_times, key=self_times.get, reverse=True)[:self.top]
+        return {'total': totals,
+                'breakdown': {name: float(np.median(cumulative_times[name]))
+                              for name in top},
+                'self': {name: self_times[name] for name in top}}
+
+
+#: Forks and times the command in its arguments, with its output
+#: discarded, then writes its wait status, duration and ru_maxrss.
+_LATENCY_HELPER = """
+import os, sys, timeit
+devnull = os.open(os.devnull, os.O_WRONLY)
+start = timeit.default_timer()
+pid = os.fork()
+if not pid:
+    os.dup2(devnull, 1)
+    try:
+        os.execvp(sys.argv[1], sys.argv[1:])
+    finally:
+        os._exit(127)
+_, status, usage = os.wait4(pid, 0)
+duration = timeit.default_timer() - start
+sys.stdout.write('{} {!r} {}\\n'.format(status, duration, usage.ru_maxrss))
+"""
+
+
+class CommandLatencyMetric(Metric):
+    """
+    Times running a command line in a subprocess, including interpreter
+    start-up, imports and I/O, as a user of the command sees it.
+
+    The command is run ``warmup`` times to warm caches, then timed
+    ``repeat`` times with its output discarded. The result is a dictionary
+    of the ``'total'`` time of each timed run, in seconds, and its
+    ``'stats'``: the mean, standard deviation, minimum, maximum, median, and
+    90th and 95th percentiles. If ``rss`` is set, the peak resident memory
+    of the command over all runs is also recorded as ``'max_rss'``, in MB.
+
+    A child's peak RSS includes the memory of the process it was forked
+    from, even after it execs the command, so with ``rss`` set the command
+    is run, and timed, by a small helper interpreter rather than by this
+    process. The recorded peak is never below the helper's own few MB.
+
+    """
+    def __init__(self, command, name=None, warmup=3, repeat=10, rss=False):
+        if isinstance(command, string_types):
+            self.line = command
+            command = shlex.split(command)
+        else:
+            self.line = subprocess.list2cmdline(command)
+        self.command = list(command)
+        self.name = name
+        self.warmup = warmup
+        self.repeat = repeat
+        self.rss = rss
+
+    def id(self):
+        return 'latency-{}'.format(self.name or self.line)
+
+    def _time(self, devnull):
+        """Returns the time taken by one run, and its peak RSS in MB."""
+        if self.rss:
+            status, duration, max_rss = self._helper_time()
+        else:
+            start = timeit.default_timer()
+            process = subprocess.Popen(self.command, stdout=devnull)
+            # Wait with wait4 to get the resource usage of just this child.
+            _, status, usage = os.wait4(process.pid, 0)
+            duration = timeit.default_timer() - start
+            max_rss = usage.ru_maxrss
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        if returncode:
+            raise RuntimeError('{!r} failed with exit code {}.'.format(
+                self.line, returncode))
+        # ru_maxrss is in kB on Linux, but bytes on OS X.
+        scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+        return duration, max_rss / float(scale)
+
+    def _helper_time(self):
+        """
+        Returns the wait status, duration and raw peak RSS of one run by
+        the helper interpreter.
+
+        """
+        helper = subprocess.Popen(
+            [sys.executable, '-S', '-c', _LATENCY_HELPER] + self.command,
+            stdout=subprocess.PIPE, universal_newlines=True)
+        output = helper.communicate()[0]
+        if helper.returncode:
+            raise RuntimeError('Timing {!r} failed.'.format(self.line))
+        status, duration, max_rss = output.split()
+        return int(status), float(duration), int(max_rss)
+
+    def run(self):
+        import numpy as np
+        with open(os.devnull, 'w') as devnull:
+            for _ in range(self.warmup):
+                self._time(devnull)
+            runs = [self._time(devnull) for _ in range(self.repeat)]
+        times = np.array([duration for duration, _ in runs])
+        p50, p90, p95 = np.percentile(times, [50, 90, 95])
+        result = {'total': times.tolist(),
+                  'stats': {'mean': times.mean(), 'stddev': times.std(),
+                            'min': times.min(), 'max': times.max(),
+                            'median': p50, 'p90': p90, 'p95': p95}}
+        if self.rss:
+            result['max_rss'] = max(rss for _, rss in runs)
+        return result
+
+
+_FULL_SHA = re.compile('^[0-9a-f]{40}$')
+_RESULT_KEY = re.compile('^[0-9a-f]{40}(-dirty)?(@[^@]+)?$')
+
+
 def sha(name):
-    output = subprocess.check_output(['git', 'log', '-1', '--format=%H', name])
+    # A full sha needs no lookup.
+    if _FULL_SHA.match(name):
+        return name
+    output = subprocess.check_output(['git', 'log', '-1', '--format=%H', name],
+                                     universal_newlines=True)
     return output.strip()
 
 
+def result_key(name):
+    """
+    Returns the key of the results of a commit name.
+
+    The results of each environment run by the ``matrix`` command are kept
+    under the commit's key followed by ``@`` and the environment name, so
+    ``HEAD@py27`` names the results of HEAD in the ``py27`` environment.
+    Reflog names such as ``HEAD@{1}`` are commit names as usual.
+
+    """
+    # Keys of results need no lookup.
+    if _RESULT_KEY.match(name):
+        return name
+    commit, at, environment = name.rpartition('@')
+    if not commit or environment.startswith('{'):
+        return sha(name)
+    return sha(commit) + at + environment
+
+
 def shorten_sha(sha):
     """
     Takes a long hex string (e.g. a git commit sha) and shortens it to
-    8 characters.
+    8 characters, keeping any ``@environment`` suffix of a results key.
 
     If the input value cannot be cast as a hex then the input is returned
     unchanged.
@@ -223,30 +734,948 @@ def shorten_sha(sha):
         if not.
 
     """
+    commit, at, environment = sha.partition('@')
     try:
-        int(sha, 16)
+        int(commit, 16)
     except ValueError:
         result = sha
     else:
-        result = sha[:8]
+        result = commit[:8] + at + environment
     return result
 
 
+_DESCRIPTION = re.compile(
+    '^(?:(?P<tag>.*)-(?P<count>[0-9]+)-g)?(?P<sha>[0-9a-f]{40})'
+    '(?P<dirty>-dirty)?$')
+
+
+def _working_tree():
+    """
+    Returns the code ID and the description of the current working tree,
+    from a single git process.
+
+    """
+    output = subprocess.check_output(['git', 'describe', '--long',
+                                      '--abbrev=40', '--dirty', '--always'],
+                                     universal_newlines=True).strip()
+    match = _DESCRIPTION.match(output)
+    dirty = match.group('dirty') or ''
+    code_id = match.group('sha') + dirty
+    if match.group('tag') is None:
+        name = code_id
+    elif match.group('count') == '0':
+        # As described without --long.
+        name = match.group('tag') + dirty
+    else:
+        name = output
+    return code_id, name
+
+
 def working_tree_id():
     try:
-        id = sha('HEAD')
-        status = subprocess.check_output('git status --porcelain -uno'.split())
-        if status.strip():
-            id += '-dirty'
+        id = _working_tree()[0]
     except subprocess.CalledProcessError:
         id = 'unknown'
     return id
 
 
 def describe_working_tree():
-    output = subprocess.check_output(['git', 'describe', '--abbrev=40',
-                                      '--dirty'])
-    return output.strip()
+    return _working_tree()[1]
+
+
+def calibrate(repeat=5):
+    """
+    Time a short, fixed reference workload on this machine.
+
+    The ratio of the calibration times of two machines is used to normalise
+    the timings made on one of them to the other.
+
+    """
+    import numpy as np
+
+    def workload():
+        sum(i * i for i in range_type(100000))
+        a = np.arange(40000, dtype=float).reshape(200, 200)
+        np.dot(a, a)
+    return min(timeit.repeat(workload, repeat=repeat, number=1))
+
+
+def host_fingerprint():
+    """
+    Describe the machine running the metrics.
+
+    Returns:
+        A dictionary of the host name, CPU model, core count, CPU frequency
+        governor, Python and NumPy versions, load average and calibration
+        time (see :func:`calibrate`) of this machine. The ``id`` entry is a
+        short hash that identifies the hardware.
+
+    """
+    import numpy as np
+    cpu = platform.processor()
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            for line in cpuinfo:
+                if line.startswith('model name'):
+                    cpu = line.split(':', 1)[1].strip()
+                    break
+    except IOError:
+        pass
+    governor_path = '/sys/devices/system/cpu/cpu0/cpufreq/scaling_governor'
+    try:
+        with open(governor_path) as governor:
+            governor = governor.read().strip()
+    except IOError:
+        governor = None
+    fingerprint = {'hostname': platform.node(),
+                   'cpu': cpu,
+                   'cores': multiprocessing.cpu_count(),
+                   'governor': governor,
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'load': list(os.getloadavg())}
+    hardware = json.dumps([fingerprint[key]
+                           for key in ('hostname', 'cpu', 'cores')])
+    fingerprint['id'] = hashlib.sha1(hardware.encode('utf-8')).hexdigest()[:12]
+    fingerprint['calibration'] = calibrate()
+    return fingerprint
+
+
+def commits_between(start, end):
+    """
+    Returns the shas of the commits on the ancestry path from ``start``
+    (exclusive) to ``end`` (inclusive), oldest first.
+
+    """
+    output = subprocess.check_output(['git', 'rev-list', '--reverse',
+                                      '--ancestry-path',
+                                      '{}..{}'.format(start, end)])
+    return output.split()
+
+
+class CommitIndex(object):
+    """
+    A persistent index of the commits of a repository, with their parents,
+    author dates and ``git describe`` names, in topological order.
+
+    The index is stored in the repository's git directory and brought up to
+    date whenever it is loaded. Only commits that aren't already indexed are
+    read, in a single ``git log`` and a few batched ``git describe`` calls.
+    Commits are ordered parents before children: new commits can never be
+    ancestors of indexed ones, so appending them keeps the order valid.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        #: The shas of the indexed commits, parents before children.
+        self.order = []
+        #: The shas of the parents of each commit.
+        self.parents = {}
+        #: The author date of each commit, as a Unix timestamp.
+        self.dates = {}
+        #: The ``git describe`` name of each commit.
+        self.names = {}
+        #: The objects that the refs pointed to when last updated.
+        self.tips = []
+        self._positions = None
+
+    @staticmethod
+    def load(repo_root=None):
+        """
+        Load the index of the repository at ``repo_root`` (by default the
+        current working directory), updating it if any refs have changed.
+
+        """
+        output = subprocess.check_output(['git', 'rev-parse',
+                                          '--git-common-dir', 'HEAD',
+                                          '--all'], cwd=repo_root)
+        git_dir, tips = output.split('\n', 1)
+        path = os.path.join(repo_root or os.getcwd(), git_dir,
+                            'tehuti-commits.json')
+        index = CommitIndex(path)
+        try:
+            with open(path, 'rb') as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            pass
+        else:
+            index.tips = stored['tips']
+            for commit, date, parents, name in stored['commits']:
+                index.order.append(commit)
+                index.dates[commit] = date
+                index.parents[commit] = parents
+                index.names[commit] = name
+        tips = sorted(set(tips.split()))
+        if tips != index.tips:
+            index.update(tips, repo_root)
+            index.save()
+        return index
+
+    def update(self, tips, repo_root=None):
+        """Add the commits reachable from ``tips`` that aren't indexed."""
+        cmd = ['git', 'log', '--topo-order', '--reverse',
+               '--format=%H %at %P', '--stdin'] + tips
+        log = subprocess.Popen(cmd, cwd=repo_root, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+        output, _ = log.communicate(''.join('^{}\n'.format(tip)
+                                            for tip in self.tips))
+        if log.returncode:
+            # An old tip no longer exists, so rebuild from scratch.
+            self.__init__(self.path)
+            return self.update(tips, repo_root)
+        new = []
+        for line in output.splitlines():
+            commit, date, parents = (line.split(' ', 2) + [''])[:3]
+            self.dates[commit] = int(date)
+            self.parents[commit] = parents.split()
+            new.append(commit)
+        self.order.extend(new)
+        for i in range(0, len(new), 200):
+            cmd = ['git', 'describe', '--always', '--abbrev=40']
+            names = subprocess.check_output(cmd + new[i:i + 200],
+                                            cwd=repo_root)
+            self.names.update(zip(new[i:i + 200], names.split()))
+        self.tips = tips
+        self._positions = None
+
+    def save(self):
+        atomic_write(self.path, json.dumps(
+            {'tips': self.tips,
+             'commits': [[commit, self.dates[commit], self.parents[commit],
+                          self.names[commit]] for commit in self.order]}))
+
+    def ancestors(self, commit):
+        """Returns the set of commits reachable from ``commit``."""
+        seen = set()
+        stack = [commit]
+        while stack:
+            commit = stack.pop()
+            if commit not in seen and commit in self.parents:
+                seen.add(commit)
+                stack.extend(self.parents[commit])
+        return seen
+
+    def select(self, commits, since=None, branch=None):
+        """
+        Order and filter commits without running git for each commit.
+
+        Args:
+
+        * commits:
+            The commits (full shas) to select from. Commits that aren't in
+            the index, such as dirty working trees, are kept after the
+            others unless a filter is given. The results keys of
+            environments (see :func:`result_key`) are ordered after their
+            commit.
+
+        Kwargs:
+
+        * since:
+            Only select commits authored at or after this Unix timestamp.
+        * branch:
+            Only select commits reachable from this commit name.
+
+        Returns:
+            The selected commits, parents before children.
+
+        """
+        if self._positions is None:
+            self._positions = {commit: i
+                               for i, commit in enumerate(self.order)}
+        known = [commit for commit in commits
+                 if commit.split('@')[0] in self._positions]
+        if since is not None:
+            known = [commit for commit in known
+                     if self.dates[commit.split('@')[0]] >= since]
+        if branch is not None:
+            reachable = self.ancestors(sha(branch))
+            known = [commit for commit in known
+                     if commit.split('@')[0] in reachable]
+        known.sort(key=lambda commit: (
+            self._positions[commit.split('@')[0]], commit))
+        if since is None and branch is None:
+            known += [commit for commit in commits
+                      if commit.split('@')[0] not in self._positions]
+        return known
+
+
+def module_path(module_name):
+    """
+    Returns the path of the source file of the named module, without
+    importing it.
+
+    """
+    loader = pkgutil.get_loader(module_name)
+    if loader is None:
+        raise ValueError('Unable to find module {!r}.'.format(module_name))
+    return loader.get_filename()
+
+
+def _static_metrics(source):
+    """
+    Build the metrics of a metrics module from its source, without running
+    it, so that their IDs can be found without importing the code they
+    measure.
+
+    Only a literal ``metrics`` list of tehuti's own metric classes is
+    understood, whose arguments are literals or functions defined in the
+    module. The functions are replaced by stubs of the same name.
+
+    Returns:
+        The metrics, or None if the source is not understood.
+
+    """
+    tree = ast.parse(source)
+    functions = set()
+    imported = {}
+    metrics = None
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            functions.add(node.name)
+        elif isinstance(node, ast.ImportFrom) and node.module == 'tehuti':
+            imported.update((alias.asname or alias.name, alias.name)
+                            for alias in node.names)
+        elif isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == 'metrics'
+                for target in node.targets):
+            metrics = node.value
+    # The list may be changed after it is assigned.
+    for node in ast.walk(tree):
+        if isinstance(node, ast.AugAssign):
+            changed = node.target
+        elif isinstance(node, ast.Attribute):
+            changed = node.value
+        else:
+            continue
+        if isinstance(changed, ast.Name) and changed.id == 'metrics':
+            return None
+    if not isinstance(metrics, ast.List):
+        return None
+
+    def stub(name):
+        def function(context):
+            pass
+        function.__name__ = name
+        return function
+
+    def value(node):
+        if isinstance(node, ast.Name) and node.id in functions:
+            return stub(node.id)
+        return ast.literal_eval(node)
+
+    built = []
+    for call in metrics.elts:
+        if not isinstance(call, ast.Call) or call.starargs or call.kwargs:
+            return None
+        func = call.func
+        if (isinstance(func, ast.Attribute) and
+                isinstance(func.value, ast.Name) and
+                func.value.id == 'tehuti'):
+            name = func.attr
+        elif isinstance(func, ast.Name) and func.id in imported:
+            name = imported[func.id]
+        else:
+            return None
+        cls = globals().get(name)
+        if not isinstance(cls, type) or not hasattr(cls, 'id'):
+            return None
+        try:
+            built.append(cls(*[value(arg) for arg in call.args],
+                             **{keyword.arg: value(keyword.value)
+                                for keyword in call.keywords}))
+        except (ValueError, TypeError):
+            return None
+    return built
+
+
+def metric_ids(metrics_module_name):
+    """
+    Returns the IDs of the metrics in the named metrics module, from its
+    manifest.
+
+    The IDs are found from the source if possible (see
+    :func:`_static_metrics`), and that manifest is cached in PKL_DIR by a
+    hash of the module's source. Otherwise the module is imported, every
+    time, as its metrics may depend on more than its source.
+
+    """
+    with open(module_path(metrics_module_name), 'rb') as f:
+        source = f.read()
+    key = hashlib.sha1(source).hexdigest()
+    manifest = _load_cache('manifest')
+    if key not in manifest:
+        metrics = _static_metrics(source)
+        if metrics is None:
+            metrics = importlib.import_module(metrics_module_name).metrics
+            return [metric.id() for metric in metrics]
+        manifest[key] = [metric.id() for metric in metrics]
+        _save_cache('manifest', manifest)
+    return manifest[key]
+
+
+class Worktree(object):
+    """
+    A temporary, detached git worktree of a single commit.
+
+    Used as a context manager, which returns the path of the checked out
+    tree and removes the worktree on exit.
+
+    """
+    def __init__(self, commit, repo_root=None):
+        self.commit = commit
+        self.repo_root = repo_root or os.getcwd()
+        self._tmp_dir = None
+
+    def __enter__(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix='tehuti-')
+        # git names the worktree after its directory, so use a unique name to
+        # allow several to be added at once.
+        path = os.path.join(self._tmp_dir, os.path.basename(self._tmp_dir))
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['git', 'worktree', 'add', '--detach',
+                                   path, self.commit],
+                                  cwd=self.repo_root, stdout=devnull,
+                                  stderr=devnull)
+        return path
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        subprocess.call(['git', 'worktree', 'prune'], cwd=self.repo_root)
+
+
+class Worker(object):
+    """
+    A persistent tehuti process which imports a metrics module once and then
+    runs its metrics on request.
+
+    The worker runs in ``cwd``, which is also put at the front of its
+    PYTHONPATH, so that when ``cwd`` is a :class:`Worktree` the measured
+    library is imported from that commit. The metrics module itself is always
+    loaded from its current source file.
+
+    """
+    def __init__(self, metrics_module_name, cwd=None, executable=None):
+        cmd = [executable or sys.executable, TEHUTI, 'worker',
+               metrics_module_name, module_path(metrics_module_name)]
+        env = dict(os.environ)
+        if cwd is not None:
+            paths = [cwd] + [p for p in [env.get('PYTHONPATH')] if p]
+            env['PYTHONPATH'] = os.pathsep.join(paths)
+        self.process = subprocess.Popen(cmd, cwd=cwd, env=env,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        #: The ``code_id`` and ``name`` of the tree the worker is running in,
+        #: the ``host`` fingerprint of its machine and the metric ``ids``.
+        self.info = self._receive()
+
+    def _receive(self):
+        line = self.process.stdout.readline()
+        if not line:
+            msg = 'Worker process exited with code {}.'
+            raise RuntimeError(msg.format(self.process.wait()))
+        return json.loads(line)
+
+    def request(self, **request):
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+        return self._receive()
+
+    def run(self, metric_id, repeat=None):
+        """
+        Run a single metric in the worker and return its result, optionally
+        overriding the number of repeats it takes.
+
+        """
+        response = self.request(id=metric_id, repeat=repeat)
+        if 'error' in response:
+            msg = 'Metric {!r} failed in worker:\n{}'
+            raise RuntimeError(msg.format(metric_id, response['error']))
+        return response['result']
+
+    def reload(self, paths):
+        """
+        Reload the modules of the changed source files ``paths`` and the
+        metrics module in the worker. See :func:`reload_modules`.
+
+        Returns:
+            The names of the reloaded modules.
+
+        """
+        response = self.request(reload=paths)
+        if 'error' in response:
+            raise RuntimeError('Reloading failed in worker:\n{}'.format(
+                response['error']))
+        self.info['ids'] = response['ids']
+        return response['reloaded']
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def run_metric(metric, repeat=None):
+    """
+    Run a metric, temporarily overriding its number of repeats if ``repeat``
+    is given and the metric takes repeated samples.
+
+    """
+    if repeat is None or not hasattr(metric, 'repeat'):
+        return metric.run()
+    original, metric.repeat = metric.repeat, repeat
+    try:
+        return metric.run()
+    finally:
+        metric.repeat = original
+
+
+def _frame_name(frame):
+    return '{}:{}'.format(frame.f_globals.get('__name__', '?'),
+                          frame.f_code.co_name)
+
+
+class StackSampler(object):
+    """
+    A low overhead statistical profiler, which samples the Python stack each
+    time the process has used ``interval`` seconds of CPU time.
+
+    Uses the SIGPROF signal, so may only be used in the main thread. If
+    ``real`` is set, the stack of the thread that entered the sampler is
+    instead sampled by a background thread every ``interval`` seconds of
+    wall clock time, which includes time spent sleeping or waiting for I/O.
+    A signal timer of wall clock time would cut sleeps short in Python 2.
+
+    """
+    def __init__(self, interval=0.001, real=False):
+        self.interval = interval
+        self.real = real
+        #: The number of samples of each stack, keyed by the stack as a tuple
+        #: of frame names, outermost first.
+        self.counts = {}
+
+    def _sample(self, signum, frame, weight=1):
+        stack = []
+        while frame is not None:
+            stack.append(_frame_name(frame))
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        self.counts[stack] = self.counts.get(stack, 0) + weight
+
+    def _sample_thread(self, thread_id):
+        last = timeit.default_timer()
+        while not self._done.wait(self.interval):
+            now = timeit.default_timer()
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                # Weight by the time since the last sample, as waking up
+                # takes longer than the interval.
+                self._sample(None, frame, (now - last) / self.interval)
+            last = now
+
+    def __enter__(self):
+        if self.real:
+            self._done = threading.Event()
+            self._thread = threading.Thread(
+                target=self._sample_thread,
+                args=(threading.current_thread().ident,))
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._handler = signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.real:
+            self._done.set()
+            self._thread.join()
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._handler)
+
+    def collapsed(self):
+        """
+        Returns the samples as collapsed stacks: one line per stack of
+        semicolon separated frame names, followed by the sampled time in
+        microseconds.
+
+        """
+        return ''.join('{} {}\n'.format(';'.join(stack),
+                                         int(count * self.interval * 1e6))
+                       for stack, count in sorted(self.counts.items()))
+
+
+def profile_metric(metric, method='sample'):
+    """
+    Run a metric under a profiler.
+
+    Args:
+
+    * metric:
+        The metric to profile.
+
+    Kwargs:
+
+    * method:
+        Either 'sample', to use a :class:`StackSampler` of CPU time, 'wall'
+        to use one of wall clock time, for metrics that sleep or wait for
+        I/O, or 'cprofile'. The cProfile output has no call stacks, so each
+        line of its output is a single function with its own (self) time.
+
+    Returns:
+        The profile in collapsed stack format, with times in microseconds.
+
+    """
+    if method in ('sample', 'wall'):
+        with StackSampler(real=method == 'wall') as sampler:
+            metric.run()
+        if not sampler.counts:
+            msg = ('No samples in the profile of {}: it is too quick to '
+                   'sample, or it waits rather than computes, in which case '
+                   'profile it with the wall method.')
+            warnings.warn(msg.format(metric.id()))
+        return sampler.collapsed()
+    elif method == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.runcall(metric.run)
+        modules = {os.path.splitext(getattr(module, '__file__', ''))[0]: name
+                   for name, module in sys.modules.items() if module}
+        lines = []
+        for (path, _, function), stats in \
+                pstats.Stats(profiler).stats.iteritems():
+            module = modules.get(os.path.splitext(path)[0], path)
+            lines.append('{}:{} {}\n'.format(module, function,
+                                              int(stats[2] * 1e6)))
+        return ''.join(sorted(lines))
+    raise ValueError('Unknown profiling method {!r}.'.format(method))
+
+
+def profile_times(collapsed):
+    """
+    Returns the self and total (inclusive) time, in microseconds, of each
+    function in a collapsed stack profile.
+
+    """
+    self_times, total_times = {}, {}
+    for line in collapsed.splitlines():
+        stack, _, weight = line.rpartition(' ')
+        stack, weight = stack.split(';'), int(weight)
+        self_times[stack[-1]] = self_times.get(stack[-1], 0) + weight
+        for function in set(stack):
+            total_times[function] = total_times.get(function, 0) + weight
+    return self_times, total_times
+
+
+def worker(metrics_module_name, metrics_module_path):
+    """
+    The main loop of a :class:`Worker` process.
+
+    Reads one JSON request per line from stdin and writes one JSON response
+    per line to stdout. Anything the metrics write to stdout is redirected to
+    stderr so that it cannot corrupt the responses.
+
+    """
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def respond(response):
+        responses.write(json.dumps(response) + '\n')
+        responses.flush()
+
+    sys.path.insert(0, os.getcwd())
+    module = load_source(metrics_module_name, metrics_module_path)
+    metrics = {metric.id(): metric for metric in module.metrics}
+    code_id, name = _working_tree()
+    respond({'code_id': code_id, 'name': name, 'host': host_fingerprint(),
+             'ids': [metric.id() for metric in module.metrics]})
+    for line in iter(sys.stdin.readline, ''):
+        request = json.loads(line)
+        if 'reload' in request:
+            response = {}
+            try:
+                response['reloaded'] = reload_modules(request['reload'])
+                module = load_source(metrics_module_name,
+                                     metrics_module_path)
+                metrics = {metric.id(): metric for metric in module.metrics}
+                response['ids'] = [metric.id() for metric in module.metrics]
+            except Exception:
+                response['error'] = traceback.format_exc()
+            respond(response)
+            continue
+        response = {'id': request['id']}
+        try:
+            response['result'] = run_metric(metrics[request['id']],
+                                            request.get('repeat'))
+        except Exception:
+            response['error'] = traceback.format_exc()
+        respond(response)
+
+
+def reload_modules(paths):
+    """
+    Reload the imported modules whose source files are among ``paths``,
+    followed by the imported modules that refer to them or to anything
+    defined in them, so that they pick up the new definitions.
+
+    Returns:
+        The names of the reloaded modules, in the order they were reloaded.
+
+    """
+    def source(module):
+        path = getattr(module, '__file__', None)
+        if path is not None:
+            return os.path.realpath(os.path.splitext(path)[0] + '.py')
+
+    paths = set(os.path.realpath(path) for path in paths)
+    modules = {name: module for name, module in sys.modules.items()
+               if module is not None and source(module) is not None}
+    order = [name for name, module in sorted(modules.items())
+             if source(module) in paths]
+    # Find the dependents of the changed modules, only among modules from
+    # the current directory, as installed packages don't change.
+    here = os.path.realpath(os.getcwd()) + os.sep
+    candidates = [name for name, module in sorted(modules.items())
+                  if source(module).startswith(here) and name not in order]
+    added = True
+    while added:
+        added = False
+        for name in list(candidates):
+            for value in vars(modules[name]).values():
+                if isinstance(value, type(sys)):
+                    depends = value.__name__ in order
+                else:
+                    depends = getattr(value, '__module__', None) in order
+                if depends:
+                    order.append(name)
+                    candidates.remove(name)
+                    added = True
+                    break
+    try:
+        reload_module = reload
+    except NameError:
+        from importlib import reload as reload_module
+    for name in order:
+        reload_module(modules[name])
+    return order
+
+
+def load_source(module_name, path):
+    """Import the named module from the source file ``path``."""
+    try:
+        import importlib.util
+    except ImportError:
+        # Python 2.
+        import imp
+        return imp.load_source(module_name, path)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def regressed(reference, values, threshold=5.0, test='min', alpha=0.05):
+    """
+    Decide whether a metric result is a regression on a reference result.
+
+    Args:
+
+    * reference:
+        The reference (known good) result of the metric.
+    * values:
+        The result of the metric to test.
+
+    Kwargs:
+
+    * threshold:
+        The percentage increase of ``values`` over ``reference`` that counts
+        as a regression. A negative threshold looks for a decrease instead,
+        for metrics where bigger is better.
+    * test:
+        How repeated samples are compared. One of 'min' or 'median', which
+        compare that statistic of each result, or 'mannwhitney', which also
+        requires a one-sided Mann-Whitney U test to be significant at the
+        ``alpha`` level. Results of a single value are always compared
+        directly.
+    * alpha:
+        The significance level of the 'mannwhitney' test.
+
+    Returns:
+        True if ``values`` is a regression on ``reference``.
+
+    """
+    import numpy as np
+    if test not in ('min', 'median', 'mannwhitney'):
+        raise ValueError('Unknown statistical test {!r}.'.format(test))
+    sign = -1 if threshold < 0 else 1
+    if isinstance(reference, dict):
+        reference = reference['total']
+    if isinstance(values, dict):
+        values = values['total']
+    if isinstance(reference, list) and isinstance(values, list):
+        statistic = min if test == 'min' else np.median
+        v1, v2 = statistic(reference), statistic(values)
+    else:
+        v1, v2 = metric_value(reference), metric_value(values)
+        test = 'min'
+    change = (float(v2) / v1 - 1) * 100
+    result = sign * change > abs(threshold)
+    if result and test == 'mannwhitney':
+        from scipy.stats import mannwhitneyu
+        alternative = 'less' if sign < 0 else 'greater'
+        _, p = mannwhitneyu(values, reference, alternative=alternative)
+        result = p < alpha
+    return result
+
+
+_JSON_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _skip_value(text, start):
+    """Returns the end index of the JSON value starting at ``start``."""
+    if text[start] not in '{[':
+        return json.JSONDecoder().raw_decode(text, start)[1]
+    depth = 0
+    for token in _JSON_TOKENS.finditer(text, start):
+        if token.group() in '{[':
+            depth += 1
+        elif token.group() in '}]':
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    raise ValueError('Unterminated JSON value at {}.'.format(start))
+
+
+def _object_entries(text):
+    """
+    Yields the key, and the start and end indices of the value, of each
+    entry of a JSON object, without decoding the values.
+
+    """
+    end = _JSON_WHITESPACE.match(text, 0).end()
+    if text[end] != '{':
+        raise ValueError('Expected a JSON object.')
+    end = _JSON_WHITESPACE.match(text, end + 1).end()
+    while text[end] != '}':
+        key, end = json.decoder.scanstring(text, end + 1)
+        start = _JSON_WHITESPACE.match(text, end + 1).end()
+        end = _skip_value(text, start)
+        yield key, start, end
+        end = _JSON_WHITESPACE.match(text, end).end()
+        if text[end] == ',':
+            end = _JSON_WHITESPACE.match(text, end + 1).end()
+
+
+def _indexed_json(obj, indent=4):
+    """
+    Encode a dictionary as ``json.dumps(obj, indent=indent)`` does, and find
+    the offsets of its values in the encoded text without scanning it.
+
+    Returns:
+        The text, and a dictionary of the ``[start, end]`` offsets of each
+        value.
+
+    """
+    if not obj:
+        return '{}', {}
+    pad = '\n' + ' ' * indent
+    chunks = ['{']
+    position = 1
+    offsets = {}
+    for i, (key, value) in enumerate(obj.iteritems()):
+        chunk = '{}{}{}: '.format(', ' if i else '', pad, json.dumps(key))
+        chunks.append(chunk)
+        position += len(chunk)
+        chunk = json.dumps(value, indent=indent).replace('\n', pad)
+        offsets[key] = [position, position + len(chunk)]
+        chunks.append(chunk)
+        position += len(chunk)
+    chunks.append('\n}')
+    return ''.join(chunks), offsets
+
+
+def print_change(key, start, end):
+    """
+    Print the change in the result of a metric from ``start`` to ``end``,
+    including the parts of its breakdown, if any, that changed most. Only
+    parts in both breakdowns are compared, as a breakdown may hold only the
+    largest parts, such as that of :class:`ImportTimeMetric`.
+
+    """
+    print(key)
+    if start == end:
+        print('    no change')
+        return
+    v1 = metric_value(start)
+    v2 = metric_value(end)
+    ratio = float(v2) / v1
+    print('    {} -> {} ({:.0f}%)'.format(v1, v2, ratio * 100))
+    if isinstance(start, dict) and isinstance(end, dict):
+        b1 = start.get('breakdown', {})
+        b2 = end.get('breakdown', {})
+        # Show the parts that changed most first.
+        changes = sorted(((part, b1[part], b2[part])
+                          for part in set(b1) & set(b2)
+                          if b1[part] != b2[part]),
+                         key=lambda change: -abs(change[2] - change[1]))
+        for part, p1, p2 in changes[:10]:
+            print('        {}: {:.4g} -> {:.4g}'.format(part, p1, p2))
+
+
+def _scale(value, scale):
+    """
+    Scale a timed metric result. The times in the tables of a dictionary
+    result, such as its breakdown, are scaled too.
+
+    """
+    if isinstance(value, list):
+        return [v * scale for v in value]
+    if isinstance(value, dict):
+        value = dict(value)
+        for key, part in value.iteritems():
+            if key == 'total':
+                value[key] = _scale(part, scale)
+            elif isinstance(part, dict):
+                value[key] = {name: v * scale for name, v in part.iteritems()}
+        return value
+    return value * scale
+
+
+def metric_value(value):
+    """
+    Returns the single value that represents a metric result: the minimum of
+    repeated samples, the total of a result with a breakdown, or the result
+    itself.
+
+    """
+    if isinstance(value, dict):
+        value = value['total']
+    if isinstance(value, list):
+        value = min(value)
+    return value
+
+
+class EventStream(object):
+    """
+    Writes events as JSON, one per line, for monitoring runs of metrics.
+
+    Each event has an ``event`` type and the ``time`` it happened, plus
+    fields specific to the type.
+
+    """
+    def __init__(self, path=None):
+        #: The file the events are appended to, or None to discard events.
+        self.file = None if path is None else open(path, 'a')
+
+    def emit(self, event, **fields):
+        if self.file is not None:
+            fields.update(event=event, time=time.time())
+            self.file.write(json.dumps(fields) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
 
 
 class Results(object):
@@ -255,19 +1684,102 @@ class Results(object):
         return os.path.join(PKL_DIR, name + '.json')
 
     @staticmethod
-    def load(name):
+    def profile_path(name, code_id, metric_id):
+        return os.path.join(PKL_DIR, name + '-profiles', code_id,
+                            urllib.quote(metric_id, safe='') + '.txt')
+
+    @staticmethod
+    def index_path(name):
+        return os.path.join(PKL_DIR, name + '.index.json')
+
+    @staticmethod
+    def _offsets(name):
+        """
+        Returns the byte offsets of the start and end of each commit's
+        results in the results cache of the named metrics module.
+
+        The offsets are read from the index written alongside the cache by
+        :meth:`save`. If the index is missing or out of date, the whole cache
+        is scanned and the index rewritten.
+
+        """
         path = Results.pkl_path(name)
-        print 'Loading cache from', path
+        index_path = Results.index_path(name)
+        stat = os.stat(path)
         try:
+            with open(index_path, 'rb') as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        if (index.get('size') != stat.st_size or
+                index.get('mtime') != stat.st_mtime):
             with open(path, 'rb') as f:
-                r = json.load(f)
-        except IOError:
-            r = {}
+                text = f.read()
+            index = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                     'offsets': {key: [start, end] for key, start, end in
+                                 _object_entries(text)}}
+            try:
+                atomic_write(index_path, json.dumps(index))
+            except (IOError, OSError):
+                pass
+        return index['offsets']
+
+    @staticmethod
+    def load(name, commits=None, metrics=None):
+        """
+        Load the results cache of the named metrics module.
+
+        If ``commits`` is given, only the results of those commits (by their
+        full code ID or results key, see :func:`result_key`) and of their
+        environments are read, which is much quicker for large caches since
+        the results of each commit are found from the index kept alongside
+        the cache. If ``metrics`` is given, only the results of those metric
+        IDs and the metadata of each commit are kept; each commit's results
+        are still decoded whole, as the JSON decoder is quicker than picking
+        out the wanted values in Python. Such partial results cannot be
+        saved.
+
+        """
+        path = Results.pkl_path(name)
+        print('Loading cache from', path)
+        r = {}
+        try:
+            if commits is None and metrics is None:
+                with open(path, 'rb') as f:
+                    r = json.load(f)
+            else:
+                offsets = Results._offsets(name)
+                selected = list(offsets)
+                if commits is not None:
+                    wanted = set(commits)
+                    selected = [key for key in selected
+                                if key in wanted or
+                                key.split('@')[0] in wanted]
+                keys = None
+                if metrics is not None:
+                    keys = METADATA_KEYS.union(metrics)
+                with open(path, 'rb') as f:
+                    for commit in selected:
+                        start, end = offsets[commit]
+                        f.seek(start)
+                        entry = json.loads(f.read(end - start))
+                        if keys is not None:
+                            entry = {key: value for key, value in
+                                     entry.iteritems() if key in keys}
+                        r[commit] = entry
+        except (IOError, OSError):
+            pass
         results = Results(r)
+        results.partial = commits is not None or metrics is not None
         return results
 
     def __init__(self, results):
         self.results = results
+        #: Whether only some of the cached results were loaded.
+        self.partial = False
+        #: Profiles made by :meth:`run` and not yet saved, keyed by
+        #: ``(code_id, metric_id)``.
+        self.profiles = {}
 
     def compare(self, start, end=None, single_id=None):
         """
@@ -276,7 +1788,8 @@ class Results(object):
         Parameters
         ----------
         start : str
-            The commit from where to start the comparison
+            The commit from where to start the comparison, or a commit and
+            environment such as ``HEAD@py27`` (see :func:`result_key`).
         end : str or None, optional
             The commit to compare against ``start``. If None, the commit
             of the current working tree will be used
@@ -285,57 +1798,428 @@ class Results(object):
             The ID of a single case to compare.
 
         """
-        start_sha = sha(start)
+        start_sha = result_key(start)
         if end is None:
             end_sha = working_tree_id()
         else:
-            end_sha = sha(end)
+            end_sha = result_key(end)
         start_results = self.results[start_sha]
         end_results = self.results[end_sha]
         for key in start_results.viewkeys() & end_results.viewkeys():
-            if key == 'name' or (single_id and key != single_id):
+            if key in METADATA_KEYS or (single_id and key != single_id):
                 continue
-            print key
-            if start_results[key] == end_results[key]:
-                print '    no change'
+            print_change(key, start_results[key], end_results[key])
+
+    def bisect(self, metrics_module_name, metric_id, good, bad,
+               threshold=5.0, test='min', alpha=0.05):
+        """
+        Find the first commit between ``good`` and ``bad`` at which a metric
+        regressed.
+
+        Each commit that needs measuring is checked out in a temporary
+        :class:`Worktree` and the single metric is run there by a
+        :class:`Worker`. Results already cached for a commit are used
+        instead, and new results are added to the cache.
+
+        Parameters
+        ----------
+        metrics_module_name : str
+            The importable name of the module containing the metric.
+        metric_id : str
+            The ID of the metric to bisect.
+        good, bad : str
+            The last known good and first known bad commits.
+        threshold, test, alpha
+            How a commit is judged to be bad compared to ``good``. See
+            :func:`regressed`.
+
+        Returns
+        -------
+        str
+            The sha of the first bad commit.
+
+        """
+        def measure(commit):
+            entry = self.results.get(commit, {})
+            if metric_id in entry:
+                print('Using cached result for', shorten_sha(commit))
+                return entry[metric_id]
+            print('Measuring', shorten_sha(commit))
+            with Worktree(commit) as path:
+                worker = Worker(metrics_module_name, path)
+                try:
+                    value = worker.run(metric_id)
+                finally:
+                    worker.close()
+            entry = self.results.setdefault(commit,
+                                            {'name': worker.info['name'],
+                                             'host': worker.info['host']})
+            entry[metric_id] = value
+            return value
+
+        good_sha, bad_sha = sha(good), sha(bad)
+        commits = commits_between(good_sha, bad_sha)
+        reference = measure(good_sha)
+
+        def is_bad(commit):
+            result = regressed(reference, measure(commit), threshold, test,
+                               alpha)
+            print('    {} is {}'.format(shorten_sha(commit),
+                                        'bad' if result else 'good'))
+            return result
+
+        if not commits or not is_bad(bad_sha):
+            msg = '{!r} is not a regression on {!r} for {!r}.'
+            raise ValueError(msg.format(bad, good, metric_id))
+        low, high = 0, len(commits) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if is_bad(commits[middle]):
+                high = middle
             else:
-                v1, v2 = start_results[key], end_results[key]
-                if isinstance(v1, list):
-                    v1, v2 = min(v1), min(v2)
-                ratio = float(v2) / v1
-                print '    {} -> {} ({:.0f}%)'.format(v1, v2, ratio * 100)
+                low = middle + 1
+        first_bad = commits[high]
+        print('First bad commit: {} ({})'.format(
+            first_bad, self.results[first_bad]['name']))
+        return first_bad
+
+    def run(self, metrics, force=False, single_id=None, merge=False,
+            profile=None, events=None):
+        """
+        Run the metrics for the current working tree, if they haven't
+        already been run.
 
-    def run(self, metrics, force=False, single_id=None):
-        code_id = working_tree_id()
+        Parameters
+        ----------
+        metrics : list
+            The metrics to run.
+        force : bool
+            Whether to re-run metrics that already have results.
+        single_id : str or None
+            The ID of a single metric to run.
+        merge : bool
+            Whether to add the results to any existing results for the
+            working tree, rather than replacing them. When the metrics are
+            run only because some of them are missing a result, such as
+            after a :meth:`bisect`, only those metrics are run, and their
+            results are always merged.
+        profile : str or None
+            If given, each metric is run once more after it has been measured,
+            with this method of :func:`profile_metric`. The profiles are saved
+            along with the results.
+        events : :class:`EventStream` or None
+            Where to report the progress of the run.
+
+        """
+        import numpy as np
+        try:
+            code_id, name = _working_tree()
+        except subprocess.CalledProcessError:
+            code_id, name = 'unknown', None
         run = False
         if force:
-            print 'Forced run of metrics'
+            print('Forced run of metrics')
             run = True
         if not run and code_id not in self.results:
-            print 'First run of metrics'
+            print('First run of metrics')
             run = True
+        missing = None
+        if not run:
+            missing = set(metric.id() for metric in metrics
+                          if metric.id() not in self.results[code_id] and
+                          (not single_id or metric.id() == single_id))
+            if missing:
+                print('Running metrics missing from results')
+                run = merge = True
         if code_id.endswith('-dirty'):
-            print 'Working tree is dirty - re-running metrics'
+            print('Working tree is dirty - re-running metrics')
             run = True
+            missing = None
+        if events is None:
+            events = EventStream()
         if run:
-            results = {'name': describe_working_tree()}
+            results = {'name': name or describe_working_tree(),
+                       'host': host_fingerprint(),
+                       'durations': {}}
+            events.emit('run_started', code_id=code_id, name=results['name'])
             for metric in metrics:
                 if single_id and metric.id() != single_id:
                     continue
+                if missing and metric.id() not in missing:
+                    continue
                 sys.stdout.write(metric.id() + ' ...')
                 sys.stdout.flush()
-                results[metric.id()] = metric.run()
-                print ' done'
-            self.results[code_id] = results
+                events.emit('metric_started', id=metric.id())
+                start = timeit.default_timer()
+                try:
+                    value = metric.run()
+                except Exception:
+                    events.emit('metric_failed', id=metric.id(),
+                                error=traceback.format_exc())
+                    raise
+                duration = timeit.default_timer() - start
+                results[metric.id()] = value
+                results['durations'][metric.id()] = duration
+                if isinstance(value, list):
+                    events.emit('samples', id=metric.id(), count=len(value),
+                                min=min(value), max=max(value),
+                                median=np.median(value))
+                events.emit('metric_finished', id=metric.id(),
+                            duration=duration, value=metric_value(value))
+                if (metric.id().split('-')[0] in TIMED_METRIC_TYPES and
+                        isinstance(value, list)):
+                    measured = sum(value) * getattr(metric, 'number', 1)
+                    events.emit('overhead', id=metric.id(),
+                                duration=duration - measured,
+                                fraction=1 - measured / duration)
+                if profile is not None:
+                    sys.stdout.write(' profiling ...')
+                    sys.stdout.flush()
+                    self.profiles[(code_id, metric.id())] = profile_metric(
+                        metric, profile)
+                print(' done')
+            events.emit('run_finished', code_id=code_id)
+            if merge and code_id in self.results:
+                self.merge(Results({code_id: results}))
+            else:
+                self.results[code_id] = results
+
+    def history(self, ids=None, statistic='min', since=None, branch=None):
+        """
+        Returns the history of each metric as an array, in commit order.
+
+        Only results of commits in the repository are included, ordered
+        parents before children (see :class:`CommitIndex`).
+
+        Parameters
+        ----------
+        ids : list or None
+            The IDs of the metrics to include. Defaults to all metrics with
+            any results.
+        statistic : str
+            How repeated samples are reduced to one value: 'min' or
+            'median'.
+        since, branch
+            Only include commits authored since a Unix timestamp, or
+            reachable from a commit name. See :meth:`CommitIndex.select`.
+
+        Returns
+        -------
+        commits : list
+            The shas of the commits, in order.
+        ids : list
+            The metric IDs.
+        data : :class:`numpy.ndarray`
+            The results, of shape ``(len(ids), len(commits))``, with NaN
+            where a commit has no result for a metric.
+
+        """
+        import numpy as np
+        reduce = {'min': np.min, 'median': np.median}[statistic]
+        index = CommitIndex.load()
+        commits = [commit for commit in index.select(self.results, since,
+                                                     branch)
+                   if commit in index.parents]
+        if ids is None:
+            ids = sorted(set(key for commit in commits
+                             for key in self.results[commit]) - METADATA_KEYS)
+        data = np.full((len(ids), len(commits)), np.nan)
+        for j, commit in enumerate(commits):
+            entry = self.results[commit]
+            for i, key in enumerate(ids):
+                if key in entry:
+                    value = entry[key]
+                    if isinstance(value, dict):
+                        value = value['total']
+                    data[i, j] = reduce(value) if isinstance(value, list) \
+                        else value
+        return commits, ids, data
+
+    def durations(self):
+        """
+        Returns the median recorded run duration of each metric, in seconds.
+
+        """
+        import numpy as np
+        durations = {}
+        for entry in self.results.itervalues():
+            for key, duration in entry.get('durations', {}).iteritems():
+                durations.setdefault(key, []).append(duration)
+        return {key: np.median(values) for key, values in durations.items()}
+
+    def merge(self, other):
+        """
+        Merge another set of results into these results, for example those
+        of another shard of the metrics (see :func:`shard`).
+
+        Results of the same commit are combined, with the metric results of
+        ``other`` taking precedence. The fingerprints of the hosts of metrics
+        measured on a different host to the one already recorded for the
+        commit are kept under 'hosts', by metric ID.
+
+        """
+        for code_id, other_entry in other.results.iteritems():
+            entry = self.results.setdefault(code_id, {})
+            for key in ('name', 'host'):
+                if key not in entry and key in other_entry:
+                    entry[key] = other_entry[key]
+            host_id = entry.get('host', {}).get('id')
+            for key, value in other_entry.iteritems():
+                if key in METADATA_KEYS:
+                    continue
+                entry[key] = value
+                key_host = _result_host(other_entry, key)
+                if key_host.get('id') not in (None, host_id):
+                    entry.setdefault('hosts', {})[key] = key_host
+                else:
+                    entry.get('hosts', {}).pop(key, None)
+            if 'durations' in other_entry:
+                entry.setdefault('durations', {}).update(
+                    other_entry['durations'])
+
+    def select_host(self, host):
+        """
+        Returns only the results measured on the given host, selected by
+        host name or fingerprint ID (see :func:`host_fingerprint`). Commits
+        with no such results are left out.
+
+        """
+        results = {}
+        for commit, entry in self.results.iteritems():
+            selected = {key: value for key, value in entry.iteritems()
+                        if key in METADATA_KEYS or
+                        _host_matches(_result_host(entry, key), host)}
+            if (_host_matches(entry.get('host', {}), host) or
+                    not METADATA_KEYS.issuperset(selected)):
+                results[commit] = selected
+        return Results(results)
+
+    def calibration(self, host):
+        """
+        Returns the calibration time of the given host name or fingerprint
+        ID: the median of those recorded with its results.
+
+        """
+        import numpy as np
+        reference = []
+        for entry in self.results.itervalues():
+            hosts = [entry.get('host', {})] + entry.get('hosts', {}).values()
+            reference.extend(set(
+                fingerprint['calibration'] for fingerprint in hosts
+                if isinstance(fingerprint, dict) and
+                _host_matches(fingerprint, host) and
+                'calibration' in fingerprint))
+        if not reference:
+            raise ValueError('No results for host {!r}.'.format(host))
+        return np.median(reference)
+
+    def normalise(self, host, reference=None):
+        """
+        Returns the results with all timings scaled to the speed of the
+        given host, by the ratio of the host calibration times
+        (see :func:`calibrate`).
+
+        Args:
+
+        * host:
+            The host name or fingerprint ID of the reference machine.
+
+        Kwargs:
+
+        * reference:
+            The calibration time of the host, if known. Defaults to its
+            :meth:`calibration` in these results, which partial results may
+            not include.
+
+        """
+        if reference is None:
+            reference = self.calibration(host)
+        results = {}
+        for commit, entry in self.results.iteritems():
+            entry = dict(entry)
+            unscaled = False
+            for key, value in entry.iteritems():
+                if key.split('-')[0] not in TIMED_METRIC_TYPES:
+                    continue
+                # Each result is scaled by the host it was measured on.
+                calibration = _result_host(entry, key).get('calibration')
+                if calibration is None:
+                    unscaled = True
+                else:
+                    entry[key] = _scale(value, reference / calibration)
+            if unscaled:
+                msg = ('No host fingerprint for some results of {}, they are '
+                       'not normalised.')
+                warnings.warn(msg.format(shorten_sha(commit)))
+            results[commit] = entry
+        return Results(results)
+
+    def fold_environments(self, environments=None):
+        """
+        Fold the results of the environments run by the ``matrix`` command
+        into the results of their commits, as metrics with the environment
+        name appended to their IDs, such as ``timeit-foo@py27``. The
+        environments can then be plotted against each other commit by
+        commit.
+
+        Args:
+
+        * environments:
+            The names of the environments to fold in. If given, only the
+            commits with results in any of them are kept. Defaults to all
+            the environments, and all commits.
+
+        """
+        results = {}
+        measured = set()
+        for commit in sorted(self.results, key=lambda key: '@' in key):
+            entry = self.results[commit]
+            commit, at, environment = commit.partition('@')
+            if not at:
+                results[commit] = dict(entry)
+                continue
+            if environments is not None and environment not in environments:
+                continue
+            measured.add(commit)
+            # Entries of older versions may have no name or host.
+            folded = results.setdefault(commit, {
+                key: entry[key] for key in ('name', 'host') if key in entry})
+            hosts = entry.get('hosts', {})
+            for key, value in entry.iteritems():
+                if key in METADATA_KEYS:
+                    continue
+                folded[key + at + environment] = value
+                host = _result_host(entry, key)
+                if host.get('id') not in (None,
+                                          folded.get('host', {}).get('id')):
+                    folded['hosts'] = dict(folded.get('hosts', {}))
+                    folded['hosts'][key + at + environment] = host
+        if environments is not None:
+            results = {commit: results[commit] for commit in measured}
+        return Results(results)
 
     def save(self, name):
+        if self.partial:
+            raise ValueError('Cannot save partially loaded results.')
         path = Results.pkl_path(name)
         if not os.path.exists(os.path.dirname(path)):
             os.makedirs(os.path.dirname(path))
-        with open(path, 'wb') as f:
-            json.dump(self.results, f, indent=4)
-
-    def summary(self, single_id=None):
+        text, offsets = _indexed_json(self.results)
+        atomic_write(path, text)
+        # Index the results of each commit for partial loading.
+        stat = os.stat(path)
+        index = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                 'offsets': offsets}
+        atomic_write(Results.index_path(name), json.dumps(index))
+        for (code_id, metric_id), profile in self.profiles.iteritems():
+            path = Results.profile_path(name, code_id, metric_id)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(profile)
+        self.profiles = {}
+
+    def summary(self, single_id=None, code_id=None):
         """
         Print a summary of the test results.
 
@@ -343,16 +2227,20 @@ class Results(object):
         ----------
         single_id - str
             The ID of the metric to summarise.
+        code_id - str
+            The code ID of the results to summarise. Defaults to that of the
+            current working tree.
 
         """
-        code_id = working_tree_id()
+        if code_id is None:
+            code_id = working_tree_id()
         results = self.results[code_id]
         for key, value in results.iteritems():
+            if key in METADATA_KEYS and key != 'name':
+                continue
             if single_id and key != single_id:
                 continue
-            if isinstance(value, list):
-                value = min(value)
-            print '{}\n    = {}'.format(key, value)
+            print('{}\n    = {}'.format(key, metric_value(value)))
 
 
 PKL_DIR = os.path.join(os.environ.get('XDG_DATA_HOME',
@@ -360,6 +2248,235 @@ PKL_DIR = os.path.join(os.environ.get('XDG_DATA_HOME',
                                                    '.local', 'share')),
                        'tehuti')
 
+#: Keys of a commit's results that are not metric results.
+METADATA_KEYS = frozenset(['name', 'host', 'hosts', 'durations',
+                           'environment'])
+
+#: Metric types (the prefix of their IDs) whose results are times, which
+#: are scaled when results are normalised to another host.
+TIMED_METRIC_TYPES = ['timeit', 'importtime', 'latency']
+
+
+def _result_host(entry, metric_id):
+    """
+    Returns the fingerprint of the host a metric of a commit's results was
+    measured on: its own under 'hosts' if it differs from the commit's host,
+    or else the commit's. Older results only list the host ID.
+
+    """
+    host = entry.get('hosts', {}).get(metric_id)
+    if host is None:
+        return entry.get('host', {})
+    if isinstance(host, string_types):
+        return {'id': host}
+    return host
+
+
+def _host_matches(fingerprint, host):
+    """Whether a host fingerprint is of the given host name or ID."""
+    return host in (fingerprint.get('hostname'), fingerprint.get('id'))
+
+#: The path of this script, used to start :class:`Worker` processes.
+TEHUTI = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+
+def change_points(data, threshold=5.0, min_size=3):
+    """
+    Detect shifts in the level of many series at once, by binary
+    segmentation with a CUSUM (difference of means) statistic.
+
+    Every segment of every series is searched for the split that maximises
+    the standardised difference between the means either side of it. Splits
+    scoring above ``threshold`` are accepted and both halves searched again,
+    with all segments of all series handled together in each round. Each
+    series' noise level is estimated robustly from the median absolute
+    deviation of its successive differences, so the shifts themselves barely
+    affect it.
+
+    Args:
+
+    * data:
+        A 2-D array with one series per row. NaN marks missing values.
+
+    Kwargs:
+
+    * threshold:
+        The score, in units of the noise level, above which a split counts as
+        a change point.
+    * min_size:
+        The fewest values allowed either side of a change point.
+
+    Returns:
+        A list of ``(row, index, before, after)`` tuples, sorted by row and
+        index, where ``index`` is the first position at the new level and
+        ``before`` and ``after`` are the medians of the neighbouring
+        segments.
+
+    """
+    import numpy as np
+    data = np.asarray(data, dtype=float)
+    rows, n = data.shape
+    valid = ~np.isnan(data)
+    sums = np.zeros((rows, n + 1))
+    sums[:, 1:] = np.cumsum(np.where(valid, data, 0), axis=1)
+    counts = np.zeros((rows, n + 1))
+    counts[:, 1:] = np.cumsum(valid, axis=1)
+    # Differences between each value and the previous valid value.
+    last = np.maximum.accumulate(np.where(valid, np.arange(n), -1), axis=1)
+    previous = np.column_stack([np.full(rows, -1, dtype=int), last[:, :-1]])
+    diffs = np.where(valid & (previous >= 0),
+                     data - data[np.arange(rows)[:, None], previous], np.nan)
+    # The first valid position at or after each split, to which splits are
+    # moved so that a change is attributed to a measured commit.
+    following = np.where(valid, np.arange(n), n)[:, ::-1]
+    following = np.minimum.accumulate(following, axis=1)[:, ::-1]
+    following = np.column_stack([following, np.full(rows, n, dtype=int)])
+    with warnings.catch_warnings():
+        # Rows with too few values give all-NaN slices.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        deviations = np.abs(diffs - np.nanmedian(diffs, axis=1)[:, None])
+        noise = 1.4826 * np.nanmedian(deviations, axis=1) / np.sqrt(2)
+        # Noise-free series (e.g. line counts) change on any real shift.
+        noise = np.fmax(noise, 1e-3 * np.nanmedian(np.abs(data), axis=1))
+        noise[~(noise > 0)] = np.inf
+
+    splits = np.arange(n + 1)
+    segments = np.array([[row, 0, n] for row in range(rows)],
+                        dtype=int).reshape(-1, 3)
+    points = []
+    while len(segments):
+        row, start, stop = segments.T
+        index = np.arange(len(row))
+        n1 = counts[row] - counts[row, start][:, None]
+        n2 = counts[row, stop][:, None] - counts[row]
+        s1 = sums[row] - sums[row, start][:, None]
+        s2 = sums[row, stop][:, None] - sums[row]
+        allowed = ((splits > start[:, None]) & (splits < stop[:, None]) &
+                   (n1 >= min_size) & (n2 >= min_size))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = (np.abs(s1 / n1 - s2 / n2) *
+                     np.sqrt(n1 * n2 / (n1 + n2)) / noise[row][:, None])
+        score = np.where(allowed, score, 0)
+        best = score.argmax(axis=1)
+        found = score[index, best] > threshold
+        best = following[row, best]
+        points.extend(zip(row[found], best[found]))
+        segments = np.concatenate([
+            np.column_stack([row[found], start[found], best[found]]),
+            np.column_stack([row[found], best[found], stop[found]])])
+
+    points.sort()
+    result = []
+    for i, (row, split) in enumerate(points):
+        start = points[i - 1][1] if i and points[i - 1][0] == row else 0
+        stop = points[i + 1][1] if (i + 1 < len(points) and
+                                    points[i + 1][0] == row) else n
+        result.append((row, split, np.nanmedian(data[row, start:split]),
+                       np.nanmedian(data[row, split:stop])))
+    return result
+
+
+def shard(metrics, index, count, durations=None):
+    """
+    Select one of ``count`` shards of the metrics.
+
+    If every metric has a recorded duration, the shards are balanced by run
+    time: metrics are allocated longest first, each to the shard with the
+    least total run time so far. Otherwise each metric goes to a shard
+    chosen by a stable hash of its ID. Either way the allocation only
+    depends on the metrics and durations, so separate jobs each running one
+    shard agree on it as long as they have the same durations. Jobs that
+    keep their own results must share the merged results of all the shards
+    back to every job (see :func:`merge`) before the next sharded run, or
+    some metrics would run in several shards and some in none.
+
+    Args:
+
+    * metrics:
+        The list of metrics to split.
+    * index:
+        The shard to select, from 1 to ``count``.
+    * count:
+        The number of shards.
+
+    Kwargs:
+
+    * durations:
+        The typical run time of each metric by ID, as from
+        :meth:`Results.durations`.
+
+    Returns:
+        The metrics in the selected shard, in their original order.
+
+    """
+    durations = durations or {}
+    if not all(metric.id() in durations for metric in metrics):
+        def bucket(metric):
+            digest = hashlib.sha1(metric.id().encode('utf-8')).hexdigest()
+            return int(digest, 16) % count
+        return [metric for metric in metrics if bucket(metric) == index - 1]
+    loads = [0.0] * count
+    selected = set()
+    for metric in sorted(metrics,
+                         key=lambda m: (-durations[m.id()], m.id())):
+        i = loads.index(min(loads))
+        loads[i] += durations[metric.id()]
+        if i == index - 1:
+            selected.add(metric.id())
+    return [metric for metric in metrics if metric.id() in selected]
+
+
+def _prometheus_labels(**labels):
+    escape = lambda value: (str(value).replace('\\', '\\\\')
+                            .replace('"', '\\"').replace('\n', '\\n'))
+    return ','.join('{}="{}"'.format(key, escape(value))
+                    for key, value in sorted(labels.items()))
+
+
+def export_prometheus(results, path, metrics_module_name, code_id=None):
+    """
+    Write the results of a commit as gauges in the Prometheus text format,
+    for the node exporter's textfile collector.
+
+    The file is written to a temporary name and then renamed, so that the
+    collector never reads a partial file.
+
+    Args:
+
+    * results:
+        The :class:`Results` to export.
+    * path:
+        The path of the file to write, which should end in ``.prom``.
+    * metrics_module_name:
+        The name of the metrics module, used as the ``module`` label.
+
+    Kwargs:
+
+    * code_id:
+        The commit whose results are exported. Defaults to the current
+        working tree.
+
+    """
+    if code_id is None:
+        code_id = working_tree_id()
+    entry = results.results[code_id]
+    common = {'module': metrics_module_name, 'commit': shorten_sha(code_id)}
+    lines = ['# HELP tehuti_metric_value The result of a tehuti metric '
+             '(the minimum of repeated samples).',
+             '# TYPE tehuti_metric_value gauge']
+    for key, value in sorted(entry.items()):
+        if key not in METADATA_KEYS:
+            lines.append('tehuti_metric_value{{{}}} {!r}'.format(
+                _prometheus_labels(metric=key, **common),
+                float(metric_value(value))))
+    lines += ['# HELP tehuti_metric_duration_seconds The time taken to run '
+              'a tehuti metric.',
+              '# TYPE tehuti_metric_duration_seconds gauge']
+    for key, duration in sorted(entry.get('durations', {}).items()):
+        lines.append('tehuti_metric_duration_seconds{{{}}} {!r}'.format(
+            _prometheus_labels(metric=key, **common), float(duration)))
+    atomic_write(path, '\n'.join(lines) + '\n')
+
 
 def list_metrics(metrics_module_name, out=None):
     """
@@ -378,14 +2495,15 @@ def list_metrics(metrics_module_name, out=None):
     """
     if out is None:
         out = sys.stdout
-    metrics = importlib.import_module(metrics_module_name).metrics
     out.write('Metrics in {!r}:\n'.format(metrics_module_name))
-    for metric in metrics:
-        out.write('    {}\n'.format(metric.id()))
+    for metric_id in metric_ids(metrics_module_name):
+        out.write('    {}\n'.format(metric_id))
 
 
 def main(metrics_module_name, ref_commit=None, target_commit=None,
-         force=False, single_id=None, repo_root=None):
+         force=False, single_id=None, repo_root=None, host=None,
+         normalise=None, shard_index=None, shard_count=None, profile=None,
+         events=None, prometheus=None):
     """
     Implements the command line interface for tehuti.
 
@@ -411,13 +2529,33 @@ def main(metrics_module_name, ref_commit=None, target_commit=None,
     repo_root : str or None
         The path of the repository being measured. If None the CWD will be
         used.
+    host : str or None
+        If given, only compare or summarise results from this host (by name
+        or fingerprint ID).
+    normalise : str or None
+        If given, normalise timings to the speed of this host (by name or
+        fingerprint ID) before comparing or summarising them.
+    shard_index, shard_count : int or None
+        If given, only run shard ``shard_index`` of ``shard_count`` shards of
+        the metrics, merging the results with those of any other shards.
+        See :func:`shard`.
+    profile : str or None
+        The method with which to profile each metric after running it, if
+        any. See :func:`profile_metric`.
+    events : str or None
+        The path of a file to append JSON events to as the metrics run. See
+        :class:`EventStream`.
+    prometheus : str or None
+        The path of a file to write the results of the current working tree
+        to, in the Prometheus text format. See :func:`export_prometheus`.
 
     """
-    metrics = importlib.import_module(metrics_module_name).metrics
-
-    if single_id is not None and single_id not in (metric.id() for
-                                                   metric in metrics):
+    if (single_id is not None and
+            single_id not in metric_ids(metrics_module_name)):
         raise ValueError('Unknown metric {!r}.'.format(single_id))
+    # Only import the metrics, and so the code they measure, to run them.
+    if target_commit is None:
+        metrics = importlib.import_module(metrics_module_name).metrics
 
     try:
         if repo_root is not None:
@@ -426,9 +2564,23 @@ def main(metrics_module_name, ref_commit=None, target_commit=None,
 
         results = Results.load(metrics_module_name)
         if target_commit is None:
-            results.run(metrics, force, single_id)
+            merge = shard_count is not None
+            if merge:
+                metrics = shard(metrics, shard_index, shard_count,
+                                results.durations())
+            events = EventStream(events)
+            try:
+                results.run(metrics, force, single_id, merge, profile, events)
+            finally:
+                events.close()
             results.save(metrics_module_name)
-    
+            if prometheus is not None:
+                export_prometheus(results, prometheus, metrics_module_name)
+
+        if normalise is not None:
+            results = results.normalise(normalise)
+        if host is not None:
+            results = results.select_host(host)
         if ref_commit is not None:
             results.compare(ref_commit, target_commit, single_id)
         else:
@@ -439,12 +2591,683 @@ def main(metrics_module_name, ref_commit=None, target_commit=None,
             os.chdir(pwd)
 
 
+def merge(metrics_module_name, paths):
+    """
+    Implements the ``merge`` command: merges results files, such as those
+    from separate shards of the metrics, into the results cache.
+
+    """
+    results = Results.load(metrics_module_name)
+    for path in paths:
+        with open(path, 'rb') as f:
+            results.merge(Results(json.load(f)))
+    results.save(metrics_module_name)
+
+
+def profile_diff(metrics_module_name, metric_id, ref_commit, target_commit,
+                 count=20):
+    """
+    Implements the ``profile-diff`` command: prints the functions whose time
+    in a metric's profile changed most between two commits.
+
+    """
+    times = []
+    for commit in (ref_commit, target_commit):
+        path = Results.profile_path(metrics_module_name, sha(commit),
+                                    metric_id)
+        try:
+            with open(path) as f:
+                times.append(profile_times(f.read()))
+        except IOError:
+            msg = 'No profile of {!r} for {!r}; run with --profile.'
+            raise ValueError(msg.format(metric_id, commit))
+    (ref_self, ref_total), (target_self, target_total) = times
+    if not ref_total and not target_total:
+        msg = ('The profiles of {!r} have no samples; if it waits rather '
+               'than computes, run with --profile wall.')
+        raise ValueError(msg.format(metric_id))
+    functions = set(ref_total) | set(target_total)
+    change = lambda f: target_self.get(f, 0) - ref_self.get(f, 0)
+    print('{:>32} {:>32}  function'.format('self time (ms)',
+                                           'total time (ms)'))
+    for function in sorted(functions, key=lambda f: -abs(change(f)))[:count]:
+        columns = []
+        for ref, target in ((ref_self, target_self),
+                            (ref_total, target_total)):
+            ref, target = ref.get(function, 0) / 1e3, target.get(function,
+                                                                 0) / 1e3
+            columns.append('{:9.1f} -> {:9.1f} ({:+9.1f})'.format(
+                ref, target, target - ref))
+        print('{} {}  {}'.format(columns[0], columns[1], function))
+
+
+#: Units of absolute budgets, as multiples of the units of metric results:
+#: seconds and MB.
+BUDGET_UNITS = {'': 1.0, 's': 1.0, 'ms': 1e-3, 'us': 1e-6,
+                'b': 2.0 ** -20, 'kb': 2.0 ** -10, 'mb': 1.0, 'gb': 2.0 ** 10}
+
+
+def read_budgets(path):
+    """
+    Read a budget file of allowed changes to metrics.
+
+    Each line maps a metric ID pattern (see :mod:`fnmatch`) to the allowed
+    change, relative or absolute, for example::
+
+        timeit-regrid*: +5%
+        memoryuse-*: +50MB
+        pylint-*: -0.5
+
+    A ``-`` sign allows a decrease of up to that amount, for metrics where
+    bigger is better. Absolute changes may be given in s, ms, us, B, KB, MB
+    or GB. Blank lines and lines starting with ``#`` are ignored.
+
+    Returns:
+        A list of ``(pattern, sign, amount, unit)`` tuples, where ``unit`` is
+        either '%' or one of :data:`BUDGET_UNITS`.
+
+    """
+    budget_re = re.compile(r'^([+-]?)([0-9.]+(?:e[+-]?[0-9]+)?)\s*'
+                           r'(%|[a-z]*)$', re.IGNORECASE)
+    budgets = []
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            pattern, _, budget = line.rpartition(':')
+            match = budget_re.match(budget.strip())
+            if not pattern or match is None or (
+                    match.group(3) != '%' and
+                    match.group(3).lower() not in BUDGET_UNITS):
+                msg = 'Invalid budget on line {} of {}: {!r}'
+                raise ValueError(msg.format(number, path, line))
+            sign, amount, unit = match.groups()
+            budgets.append((pattern.strip(), -1 if sign == '-' else 1,
+                            float(amount), unit.lower()))
+    return budgets
+
+
+def check(metrics_module_name, budget_path, ref_commit, target_commit=None,
+          allow_missing=False):
+    """
+    Implements the ``check`` command: checks the changes in metrics between
+    two commits against a budget file (see :func:`read_budgets`).
+
+    Only the results of the two commits are loaded from the cache. A
+    budgeted metric with a result for only one of the commits, and a budget
+    pattern that matches no metric, fail the check unless ``allow_missing``
+    is set.
+
+    Returns
+    -------
+    int
+        The number of budgets that were exceeded, plus the number of missing
+        results and unmatched patterns if not ``allow_missing``.
+
+    """
+    budgets = read_budgets(budget_path)
+    ref_sha = result_key(ref_commit)
+    target_sha = working_tree_id() if target_commit is None else \
+        result_key(target_commit)
+    results = Results.load(metrics_module_name, [ref_sha, target_sha])
+    for code_id, name in ((ref_sha, ref_commit),
+                          (target_sha, target_commit or 'working tree')):
+        if code_id not in results.results:
+            raise ValueError('No results for {} ({}).'.format(
+                name, shorten_sha(code_id)))
+    ref_results = results.results[ref_sha]
+    target_results = results.results[target_sha]
+    keys = sorted((set(ref_results) | set(target_results)) - METADATA_KEYS)
+    violations = 0
+    missing = 'skip' if allow_missing else 'FAIL'
+    for pattern, sign, amount, unit in budgets:
+        matched = fnmatch.filter(keys, pattern)
+        if not matched:
+            violations += not allow_missing
+            print('{:4} {}: no metric matches'.format(missing, pattern))
+        for key in matched:
+            if key not in ref_results or key not in target_results:
+                violations += not allow_missing
+                print('{:4} {}: no result for {}'.format(
+                    missing, key, ref_commit if key not in ref_results else
+                    target_commit or 'working tree'))
+                continue
+            v1 = metric_value(ref_results[key])
+            v2 = metric_value(target_results[key])
+            if unit == '%':
+                change = (float(v2) / v1 - 1) * 100
+                change_str = '{:+.1f}%'.format(change)
+            else:
+                change = (v2 - v1) / BUDGET_UNITS[unit]
+                change_str = '{:+.4g}{}'.format(change, unit)
+            failed = sign * change > amount
+            violations += failed
+            print('{:4} {}: {} (budget {}{:g}{}; {} -> {})'.format(
+                'FAIL' if failed else 'ok', key, change_str,
+                '-' if sign < 0 else '+', amount, unit, v1, v2))
+    return violations
+
+
+def analyse(metrics_module_name, single_id=None, threshold=5.0, min_size=3,
+            statistic='min', since=None, branch=None):
+    """
+    Implements the ``analyse`` command: lists the commits at which the level
+    of each metric shifted, over its whole history. See
+    :func:`change_points`.
+
+    """
+    results = Results.load(metrics_module_name)
+    ids = None if single_id is None else [single_id]
+    commits, ids, data = results.history(ids, statistic, since, branch)
+    points = change_points(data, threshold, min_size)
+    row = None
+    for point_row, index, before, after in points:
+        if point_row != row:
+            row = point_row
+            print(ids[row])
+        commit = commits[index]
+        print('    {} ({}): {:.4g} -> {:.4g} ({:+.1f}%)'.format(
+            shorten_sha(commit), results.results[commit]['name'], before,
+            after, (after / before - 1) * 100))
+    return [(ids[row], commits[index], before, after)
+            for row, index, before, after in points]
+
+
+def date_option(value):
+    """
+    Converts a YYYY-MM-DD date command line option to a Unix timestamp.
+
+    """
+    try:
+        return time.mktime(time.strptime(value, '%Y-%m-%d'))
+    except ValueError:
+        msg = 'expected a date of the form YYYY-MM-DD, got {!r}'
+        raise argparse.ArgumentTypeError(msg.format(value))
+
+
+def _shard_option(value):
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        index = count = 0
+    if not 1 <= index <= count:
+        msg = 'expected a shard of the form i/N with 1 <= i <= N, got {!r}'
+        raise argparse.ArgumentTypeError(msg.format(value))
+    return index, count
+
+
+def environment_option(value):
+    """
+    Converts a ``[NAME=]PYTHON`` command line option to the name and Python
+    interpreter of an environment. PYTHON may be an interpreter or the
+    directory of a virtualenv, and NAME defaults to its base name.
+
+    """
+    name, _, python = value.rpartition('=')
+    if os.path.isdir(python):
+        python = os.path.join(python, 'bin', 'python')
+    name = name or os.path.basename(os.path.normpath(
+        value if os.path.isdir(value) else python))
+    if not name or '@' in name:
+        msg = 'expected an environment of the form [NAME=]PYTHON, where ' \
+              'NAME has no "@", got {!r}'
+        raise argparse.ArgumentTypeError(msg.format(value))
+    return name, python
+
+
+def bisect(metrics_module_name, metric_id, good, bad, threshold=5.0,
+           test='min', alpha=0.05):
+    """
+    Implements the ``bisect`` command, saving any new results to the cache.
+    See :meth:`Results.bisect`.
+
+    """
+    results = Results.load(metrics_module_name)
+    try:
+        return results.bisect(metrics_module_name, metric_id, good, bad,
+                              threshold, test, alpha)
+    finally:
+        results.save(metrics_module_name)
+
+
+def ab(metrics_module_name, ref_commit, target_commit, single_id=None,
+       repeat=20, seed=None):
+    """
+    Implements the ``ab`` command: an interleaved, paired comparison of two
+    commits.
+
+    Both commits are checked out in their own :class:`Worktree` with a
+    persistent :class:`Worker`. Each repeat of a metric is run once on each
+    commit, in random order, so that drift in the machine's performance
+    affects both sides of every pair equally. The change is reported as the
+    median of the paired ratios, with a bootstrapped 95% confidence interval.
+
+    Parameters
+    ----------
+    metrics_module_name : str
+        The importable name of the module being measured.
+    ref_commit, target_commit : str
+        The commits to compare.
+    single_id : str or None
+        The ID of a single metric to compare.
+    repeat : int
+        The number of pairs of samples to take of each metric.
+    seed : int or None
+        The seed for the random ordering of each pair.
+
+    Returns
+    -------
+    dict
+        The median ratio of target to reference, and its confidence interval,
+        keyed by metric ID.
+
+    """
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    changes = {}
+    with Worktree(sha(ref_commit)) as ref_path, \
+            Worktree(sha(target_commit)) as target_path:
+        workers = []
+        try:
+            workers.append(Worker(metrics_module_name, ref_path))
+            workers.append(Worker(metrics_module_name, target_path))
+            ids = workers[0].info['ids']
+            if single_id is not None:
+                ids = [single_id]
+            for key in ids:
+                pairs = []
+                for _ in range(repeat):
+                    pair = [None, None]
+                    for i in rng.permutation(2):
+                        pair[i] = workers[i].run(key, repeat=1)
+                    # Pair the sampled totals of metrics with a breakdown.
+                    samples = [value['total'] if isinstance(value, dict)
+                               else value for value in pair]
+                    if not isinstance(samples[0], list):
+                        break
+                    pairs.append([samples[0][0], samples[1][0]])
+                if not pairs:
+                    print_change(key, pair[0], pair[1])
+                    continue
+                print(key)
+                pairs = np.array(pairs, dtype=float)
+                log_ratios = np.log(pairs[:, 1] / pairs[:, 0])
+                samples = rng.randint(len(log_ratios),
+                                      size=(1000, len(log_ratios)))
+                low, high = np.exp(np.percentile(
+                    np.median(log_ratios[samples], axis=1), [2.5, 97.5]))
+                ratio = np.exp(np.median(log_ratios))
+                changes[key] = (ratio, low, high)
+                msg = '    {} -> {} ({:+.1f}%, 95% CI {:+.1f}% to {:+.1f}%)'
+                print(msg.format(pairs[:, 0].min(), pairs[:, 1].min(),
+                                 (ratio - 1) * 100, (low - 1) * 100,
+                                 (high - 1) * 100))
+        finally:
+            for worker in workers:
+                worker.close()
+    return changes
+
+
+def matrix(metrics_module_name, environments, single_id=None, force=False,
+           parallel=True):
+    """
+    Implements the ``matrix`` command: runs the metrics of the current
+    working tree under each of several Python environments, such as
+    different Python versions or NumPy builds, and compares each
+    environment with the first.
+
+    Each environment runs the metrics in its own :class:`Worker`, started
+    with the environment's interpreter. The results of an environment are
+    stored under the working tree's code ID followed by ``@`` and the
+    environment name (see :func:`result_key`), and are only re-run if
+    forced or if the working tree is dirty.
+
+    Parameters
+    ----------
+    metrics_module_name : str
+        The importable name of the module being measured.
+    environments : list of (str, str)
+        The name and Python interpreter of each environment. See
+        :func:`environment_option`.
+    single_id : str or None
+        The ID of a single metric to run.
+    force : bool
+        Whether to re-run environments that already have results.
+    parallel : bool
+        Whether to run all the environments at once. Timings are steadier
+        when the environments run one after another.
+
+    """
+    names = [name for name, _ in environments]
+    if len(set(names)) != len(names):
+        raise ValueError('Environment names must be unique.')
+    if (single_id is not None and
+            single_id not in metric_ids(metrics_module_name)):
+        raise ValueError('Unknown metric {!r}.'.format(single_id))
+    results = Results.load(metrics_module_name)
+    code_id = working_tree_id()
+    todo = []
+    for name, python in environments:
+        if (force or code_id.endswith('-dirty') or
+                '{}@{}'.format(code_id, name) not in results.results):
+            todo.append((name, python))
+        else:
+            print('Using cached results for', name)
+    entries = {}
+    errors = {}
+
+    def run(name, python):
+        worker = None
+        try:
+            worker = Worker(metrics_module_name, executable=python)
+            entry = {'name': worker.info['name'],
+                     'host': worker.info['host'],
+                     'environment': {'name': name, 'python': python},
+                     'durations': {}}
+            for metric_id in worker.info['ids']:
+                if single_id and metric_id != single_id:
+                    continue
+                start = timeit.default_timer()
+                entry[metric_id] = worker.run(metric_id)
+                entry['durations'][metric_id] = (timeit.default_timer() -
+                                                 start)
+                print('{} @ {} done'.format(metric_id, name))
+            entries[name] = entry
+        except Exception as error:
+            errors[name] = str(error)
+        finally:
+            if worker is not None:
+                worker.close()
+
+    if parallel:
+        threads = [threading.Thread(target=run, args=environment)
+                   for environment in todo]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        for name, python in todo:
+            run(name, python)
+
+    # The calibration workload runs faster under some interpreters than
+    # others, so normalising each environment by its own calibration would
+    # hide the very differences being measured. Use that of the first.
+    calibration = None
+    for name in names:
+        key = '{}@{}'.format(code_id, name)
+        entry = entries.get(name, results.results.get(key))
+        if entry is None:
+            continue
+        if calibration is None:
+            calibration = entry['host']['calibration']
+        if name in entries:
+            entry['host']['calibration'] = calibration
+            results.results[key] = entry
+    results.save(metrics_module_name)
+
+    keys = ['{}@{}'.format(code_id, name) for name in names]
+    keys = [key for key in keys if key in results.results]
+    for key in keys[1:]:
+        print('{} -> {}'.format(keys[0].split('@')[1], key.split('@')[1]))
+        results.compare(keys[0], key, single_id)
+    if errors:
+        raise RuntimeError('\n'.join(
+            'Environment {!r} failed:\n{}'.format(name, errors[name])
+            for name in names if name in errors))
+    return results
+
+
+def _source_mtimes(paths):
+    """
+    Returns the modification time of each Python source file in or under
+    the given paths, skipping hidden directories.
+
+    """
+    mtimes = {}
+    for path in paths:
+        if os.path.isfile(path):
+            mtimes[path] = os.path.getmtime(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+            for name in names:
+                if name.endswith('.py'):
+                    source = os.path.join(root, name)
+                    try:
+                        mtimes[source] = os.path.getmtime(source)
+                    except OSError:
+                        # Removed while walking.
+                        pass
+    return mtimes
+
+
+def watch(metrics_module_name, patterns=None, repeat=None, poll=0.5):
+    """
+    Re-run metrics whenever the Python source in the current directory or
+    the metrics module changes, printing the change in each from the
+    results of the HEAD commit.
+
+    The metrics are run by a single :class:`Worker`, which stays running, so
+    libraries and the metrics module are only imported once. On each change
+    only the changed modules, the modules that depend on them and the
+    metrics module are reloaded in the worker (see :func:`reload_modules`).
+    The source is polled for changes.
+
+    Args:
+
+    * metrics_module_name:
+        The importable name of the metrics module.
+
+    Kwargs:
+
+    * patterns:
+        Only run metrics whose IDs match one of these fnmatch patterns.
+    * repeat:
+        Override the number of repeats of each metric, for quicker runs.
+    * poll:
+        The number of seconds between checks for changes.
+
+    """
+    head = sha('HEAD')
+    reference = Results.load(metrics_module_name, [head]).results.get(head,
+                                                                      {})
+    watched = [os.getcwd(), module_path(metrics_module_name)]
+    mtimes = _source_mtimes(watched)
+    worker = Worker(metrics_module_name)
+    try:
+        loaded = True
+        while True:
+            ids = worker.info['ids'] if loaded else []
+            if patterns:
+                ids = [metric_id for metric_id in ids
+                       if any(fnmatch.fnmatch(metric_id, pattern)
+                              for pattern in patterns)]
+            for metric_id in ids:
+                try:
+                    value = worker.run(metric_id, repeat)
+                except RuntimeError as error:
+                    print(error)
+                    continue
+                if metric_id in reference:
+                    print_change(metric_id, reference[metric_id], value)
+                else:
+                    print('{}\n    = {}'.format(metric_id,
+                                               metric_value(value)))
+            print('Watching for changes ...')
+            changed = None
+            while not changed:
+                time.sleep(poll)
+                current = _source_mtimes(watched)
+                changed = sorted(path for path in set(mtimes) | set(current)
+                                 if mtimes.get(path) != current.get(path))
+                mtimes = current
+            print('Changed: {}'.format(', '.join(
+                os.path.relpath(path) for path in changed)))
+            try:
+                worker.reload([path for path in changed
+                               if os.path.exists(path)])
+                loaded = True
+            except RuntimeError as error:
+                # Wait for the source to be fixed.
+                print(error)
+                loaded = False
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
+
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
+    commands = argparse.ArgumentParser(prog='tehuti.py')
+    subparsers = commands.add_subparsers(dest='command')
+    parser = subparsers.add_parser('worker')
+    parser.add_argument('metrics_module')
+    parser.add_argument('metrics_module_path')
+    parser = subparsers.add_parser(
+        'analyse', help='find the commits at which metrics shifted level')
+    parser.add_argument('metrics_module')
+    parser.add_argument('-i', '--id', help='select a single metric by ID')
+    parser.add_argument('-t', '--threshold', type=float, default=5.0,
+                        help='the score, in units of noise, of a change')
+    parser.add_argument('--min-size', type=int, default=3,
+                        help='the fewest commits between changes')
+    parser.add_argument('--statistic', choices=['min', 'median'],
+                        default='min',
+                        help='how repeated samples are reduced')
+    parser.add_argument('--since', type=date_option, metavar='YYYY-MM-DD',
+                        help='only analyse commits authored since this date')
+    parser.add_argument('--branch',
+                        help='only analyse commits reachable from this one')
+    parser = subparsers.add_parser(
+        'check', help='check changes in metrics against a budget file')
+    parser.add_argument('metrics_module')
+    parser.add_argument('budget_file')
+    parser.add_argument('ref_commit', metavar='reference commit')
+    parser.add_argument('target_commit', nargs='?', metavar='target commit')
+    parser.add_argument('--allow-missing', action='store_true',
+                        help='pass budgets of metrics without results')
+    parser = subparsers.add_parser(
+        'profile-diff',
+        help='show the functions that account for a change in a metric')
+    parser.add_argument('metrics_module')
+    parser.add_argument('metric_id')
+    parser.add_argument('ref_commit', metavar='reference commit')
+    parser.add_argument('target_commit', metavar='target commit')
+    parser.add_argument('-n', '--count', type=int, default=20,
+                        help='the number of functions to show')
+    parser = subparsers.add_parser(
+        'merge', help='merge results files, e.g. from separate shards')
+    parser.add_argument('metrics_module')
+    parser.add_argument('paths', nargs='+', metavar='path')
+    parser = subparsers.add_parser(
+        'ab', help='compare two commits by interleaved, paired sampling')
+    parser.add_argument('metrics_module')
+    parser.add_argument('ref_commit', metavar='reference commit')
+    parser.add_argument('target_commit', metavar='target commit')
+    parser.add_argument('-i', '--id', help='select a single metric by ID')
+    parser.add_argument('-r', '--repeat', type=int, default=20,
+                        help='the number of pairs of samples per metric')
+    parser.add_argument('--seed', type=int,
+                        help='seed for the random order of each pair')
+    parser = subparsers.add_parser(
+        'watch', help='re-run metrics in a warm process as the source changes')
+    parser.add_argument('metrics_module')
+    parser.add_argument('-i', '--id', nargs='+', metavar='PATTERN',
+                        help='only run metrics whose IDs match these patterns')
+    parser.add_argument('-r', '--repeat', type=int,
+                        help='override the number of repeats of each metric')
+    parser.add_argument('--poll', type=float, default=0.5,
+                        help='the seconds between checks for changes')
+    parser = subparsers.add_parser(
+        'matrix', help='run the metrics under several Python environments')
+    parser.add_argument('metrics_module')
+    parser.add_argument('environments', nargs='+', type=environment_option,
+                        metavar='[NAME=]PYTHON',
+                        help='a Python interpreter or virtualenv directory')
+    parser.add_argument('-i', '--id', help='select a single metric by ID')
+    parser.add_argument('-f', '--force', action='store_true')
+    parser.add_argument('--serial', action='store_true',
+                        help='run one environment at a time, for steadier '
+                             'timings')
+    parser = subparsers.add_parser(
+        'bisect', help='find the first commit at which a metric regressed')
+    parser.add_argument('metrics_module')
+    parser.add_argument('metric_id')
+    parser.add_argument('good', metavar='good commit')
+    parser.add_argument('bad', metavar='bad commit')
+    parser.add_argument('-t', '--threshold', type=float, default=5.0,
+                        help='the percentage change that counts as a '
+                             'regression; negative to look for a decrease')
+    parser.add_argument('--test', default='min',
+                        choices=['min', 'median', 'mannwhitney'],
+                        help='how repeated samples are compared')
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help='significance level of the mannwhitney test')
+
+    if sys.argv[1:2] and sys.argv[1] in subparsers.choices:
+        options = commands.parse_args()
+        if options.command == 'worker':
+            worker(options.metrics_module, options.metrics_module_path)
+        elif options.command == 'analyse':
+            analyse(options.metrics_module, options.id, options.threshold,
+                    options.min_size, options.statistic, options.since,
+                    options.branch)
+        elif options.command == 'check':
+            try:
+                violations = check(options.metrics_module,
+                                   options.budget_file, options.ref_commit,
+                                   options.target_commit,
+                                   options.allow_missing)
+            except ValueError as error:
+                sys.exit('error: {}'.format(error))
+            if violations:
+                sys.exit(1)
+        elif options.command == 'profile-diff':
+            profile_diff(options.metrics_module, options.metric_id,
+                         options.ref_commit, options.target_commit,
+                         options.count)
+        elif options.command == 'merge':
+            merge(options.metrics_module, options.paths)
+        elif options.command == 'ab':
+            ab(options.metrics_module, options.ref_commit,
+               options.target_commit, options.id, options.repeat,
+               options.seed)
+        elif options.command == 'watch':
+            watch(options.metrics_module, options.id, options.repeat,
+                  options.poll)
+        elif options.command == 'matrix':
+            matrix(options.metrics_module, options.environments, options.id,
+                   options.force, not options.serial)
+        elif options.command == 'bisect':
+            bisect(options.metrics_module, options.metric_id, options.good,
+                   options.bad, options.threshold, options.test,
+                   options.alpha)
+        sys.exit()
+
+    parser = argparse.ArgumentParser(
+        epilog='Other commands: {}. See "tehuti.py <command> -h".'.format(
+            ', '.join(sorted(set(subparsers.choices) - {'worker'}))))
     parser.add_argument('-l', '--list', action='store_true', default=False,
                         help='list the metrics in the specified module')
     parser.add_argument('-f', '--force', action='store_true')
     parser.add_argument('-i', '--id', help='select a single metric by ID')
+    parser.add_argument('--host',
+                        help='only use results from this host name or ID')
+    parser.add_argument('--normalise', metavar='HOST',
+                        help='normalise timings to the speed of this host')
+    parser.add_argument('--shard', type=_shard_option, metavar='i/N',
+                        help='only run shard i of N shards of the metrics, '
+                             'balanced by their recorded run times if all '
+                             'have one; share the merged results with '
+                             'every shard job')
+    parser.add_argument('--profile', choices=['sample', 'wall', 'cprofile'],
+                        help='profile each metric after measuring it')
+    parser.add_argument('--events', metavar='PATH',
+                        help='append JSON events to this file during runs')
+    parser.add_argument('--prometheus', metavar='PATH',
+                        help='write the results to this Prometheus textfile')
     parser.add_argument('metrics_module')
     parser.add_argument('ref_commit', nargs='?', metavar='reference commit')
     parser.add_argument('target_commit', nargs='?', metavar='target commit')
@@ -453,5 +3276,9 @@ if __name__ == '__main__':
     if options.list:
         list_metrics(options.metrics_module)
     else:
+        shard_index, shard_count = options.shard or (None, None)
         main(options.metrics_module, options.ref_commit, options.target_commit,
-             options.force, options.id)
+             options.force, options.id, host=options.host,
+             normalise=options.normalise, shard_index=shard_index,
+             shard_count=shard_count, profile=options.profile,
+             events=options.events, prometheus=options.prometheus)
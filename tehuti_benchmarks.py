@@ -0,0 +1,243 @@
+# (C) British Crown Copyright 2015, Met Office
+#
+# This file is part of Tehuti.
+#
+# Tehuti is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tehuti is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with Tehuti.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Metrics of tehuti's own performance, so that it can be tracked commit over
+commit with tehuti itself::
+
+    python tehuti.py tehuti_benchmarks
+
+The metrics run against synthetic results from :func:`synthetic_results`.
+Results are saved to and loaded from a temporary directory rather than the
+results store.
+
+"""
+import atexit
+from contextlib import contextmanager
+import hashlib
+import imp
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import tehuti
+
+
+#: The history lengths, in commits, at which loading and saving are timed.
+HISTORY_SIZES = [10, 1000, 10000]
+
+#: The number of samples taken by each run of a metric whose overhead is
+#: measured. The overhead metrics time whole runs, so it is in their names.
+OVERHEAD_SAMPLES = 100
+
+_TMP_DIR = None
+_HISTORIES = {}
+_VIS = None
+
+
+def synthetic_results(commits, metrics=10, samples=5, seed=0):
+    """
+    Make the results of a synthetic history, in the form of a tehuti
+    results store.
+
+    Each commit has ``timeit-`` and ``memoryuse-`` results of ``samples``
+    samples for each of ``metrics`` benchmarks, plus a ``linecount-`` result
+    with a breakdown, and the metadata of a real run.
+
+    Args:
+
+    * commits:
+        The number of commits.
+
+    Kwargs:
+
+    * metrics:
+        The number of benchmarks.
+    * samples:
+        The number of samples in each repeated result.
+    * seed:
+        The seed of the random results.
+
+    Returns:
+        The results, keyed by fake commit shas.
+
+    """
+    rng = random.Random(seed)
+    host = {'hostname': 'synthetic', 'cpu': 'synthetic', 'cores': 1,
+            'governor': None, 'python': '2.7', 'numpy': None, 'load': 0.0,
+            'id': 'synthetic', 'calibration': 1.0}
+    results = {}
+    for i in range(commits):
+        sha = hashlib.sha1(str(i)).hexdigest()
+        entry = {'name': 'v1.0-{}-g{}'.format(i, sha[:7]), 'host': host,
+                 'durations': {}}
+        for j in range(metrics):
+            level = 1 + 0.1 * (j + i // 100)
+            entry['timeit-bench{}'.format(j)] = [
+                rng.gauss(level, 0.01) * 1e-3 for _ in range(samples)]
+            entry['memoryuse-bench{}'.format(j)] = [
+                rng.gauss(level, 0.01) * 100 for _ in range(samples)]
+            entry['durations']['timeit-bench{}'.format(j)] = 0.1
+        entry['linecount-*.py'] = {'total': 1000 + i,
+                                   'breakdown': {'.': 900, 'lib': 100 + i}}
+        results[sha] = entry
+    return results
+
+
+def _history(commits):
+    """Returns synthetic results of the given length, made only once."""
+    if commits not in _HISTORIES:
+        _HISTORIES[commits] = synthetic_results(commits)
+    return _HISTORIES[commits]
+
+
+def _tmp_dir():
+    global _TMP_DIR
+    if _TMP_DIR is None:
+        _TMP_DIR = tempfile.mkdtemp(prefix='tehuti-benchmarks-')
+        atexit.register(shutil.rmtree, _TMP_DIR, True)
+    return _TMP_DIR
+
+
+@contextmanager
+def _isolated():
+    """
+    Keep the results store in a temporary directory, and discard printed
+    output.
+
+    """
+    pkl_dir, stdout = tehuti.PKL_DIR, sys.stdout
+    tehuti.PKL_DIR = _tmp_dir()
+    try:
+        with open(os.devnull, 'w') as sys.stdout:
+            yield
+    finally:
+        tehuti.PKL_DIR, sys.stdout = pkl_dir, stdout
+
+
+def _vis_module():
+    """Returns the tehuti-vis module, with a non-interactive backend."""
+    global _VIS
+    if _VIS is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        _VIS = imp.load_source(
+            'tehuti_vis', os.path.join(os.path.dirname(tehuti.__file__),
+                                       'tehuti-vis.py'))
+    return _VIS
+
+
+def _save_setup(commits):
+    def setup(context):
+        context.results = tehuti.Results(_history(commits))
+        context.name = 'history-{}'.format(commits)
+    return setup
+
+
+def _save(context):
+    with _isolated():
+        context.results.save(context.name)
+
+
+def _load_setup(commits, selected=None):
+    def setup(context):
+        context.name = 'history-{}'.format(commits)
+        with _isolated():
+            if not os.path.exists(tehuti.Results.pkl_path(context.name)):
+                tehuti.Results(_history(commits)).save(context.name)
+        context.commits = None
+        if selected is not None:
+            context.commits = sorted(_history(commits))[:selected]
+    return setup
+
+
+def _load(context):
+    with _isolated():
+        tehuti.Results.load(context.name, context.commits)
+
+
+def _report_setup(context):
+    results = _history(1000)
+    context.results = tehuti.Results(results)
+    context.start, context.end = sorted(results)[:2]
+
+
+def compare(context):
+    with _isolated():
+        context.results.compare(context.start, context.end)
+
+
+def summary(context):
+    with _isolated():
+        context.results.summary(code_id=context.end)
+
+
+def _nothing(context):
+    pass
+
+
+def timemetric_overhead(context):
+    tehuti.TimeMetric(_nothing, repeat=OVERHEAD_SAMPLES).run()
+
+
+def memorymetric_overhead(context):
+    tehuti.MemoryMetric(_nothing, repeat=OVERHEAD_SAMPLES).run()
+
+
+#: The metrics selected by each visualiser state.
+_STATE_METRICS = {'basic': ['timeit-bench0', 'timeit-bench1'],
+                  'violin': ['timeit-bench0', 'timeit-bench1'],
+                  'many': ['timeit-bench0', 'memoryuse-bench0'],
+                  'setup': ['timeit-bench0', 'timeit-bench1']}
+
+
+def _select_setup(method):
+    def setup(context):
+        context.vis = _vis_module()
+        context.results = _history(1000)
+        context.commits = sorted(context.results)
+        context.method = method
+    return setup
+
+
+def _select_data(context):
+    # A new visualiser each time, as a user's plot would make.
+    visualiser = context.vis.Vis(context.results, context.method)
+    visualiser.select_data(context.commits, _STATE_METRICS[context.method])
+
+
+metrics = []
+for size in HISTORY_SIZES:
+    repeat = 20 if size < 10000 else 3
+    metrics.append(tehuti.TimeMetric(_save, _save_setup(size), repeat=repeat,
+                                     name='save-{}'.format(size)))
+    metrics.append(tehuti.TimeMetric(_load, _load_setup(size), repeat=repeat,
+                                     name='load-{}'.format(size)))
+metrics.append(tehuti.TimeMetric(_load, _load_setup(10000, 2), repeat=20,
+                                 name='load-2-of-10000'))
+metrics += [tehuti.TimeMetric(compare, _report_setup, repeat=20),
+            tehuti.TimeMetric(summary, _report_setup, repeat=20),
+            tehuti.TimeMetric(timemetric_overhead, repeat=20,
+                              name='timemetric_overhead_{}_samples'.format(
+                                  OVERHEAD_SAMPLES)),
+            tehuti.TimeMetric(memorymetric_overhead, repeat=20,
+                              name='memorymetric_overhead_{}_samples'.format(
+                                  OVERHEAD_SAMPLES))]
+metrics += [tehuti.TimeMetric(_select_data, _select_setup(method),
+                              repeat=10, name='select-{}'.format(method))
+            for method in sorted(_STATE_METRICS)]
@@ -16,45 +16,427 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with Tehuti.  If not, see <http://www.gnu.org/licenses/>.
 from collections import OrderedDict
+import hashlib
+from itertools import chain
 import warnings
 
 import matplotlib.pyplot as plt
 import numpy as np
-from scipy.stats import gaussian_kde
 
-from tehuti import shorten_sha
+from tehuti import METADATA_KEYS, change_points, shorten_sha
 
 
 Y_AXIS_LABELS = {'timeit': 'Time (s)',
                  'linecount': 'Number of lines',
                  'pylint': 'PyLint score',
                  'memoryuse': 'Memory (MB)',
-                 'accuracy': 'Accuracy (%)'}
+                 'accuracy': 'Accuracy (%)',
+                 'importtime': 'Time (s)',
+                 'latency': 'Time (s)'}
+
+#: The most commits labelled along the x axis of a downsampled plot.
+MAX_TICK_LABELS = 30
+
+#: The most change points kept in a downsampled series, as a fraction of
+#: the number of points it is downsampled to.
+CHANGE_POINT_FRACTION = 0.1
+
+
+def result_samples(value):
+    """
+    Returns the samples of one result, as a list: the total of a breakdown
+    result, and a single-valued result as a one-item list.
+
+    """
+    if isinstance(value, dict):
+        value = value['total']
+    return value if isinstance(value, list) else [value]
+
+
+def _column_samples(column):
+    """
+    Returns the number of samples of each result in a column of results,
+    with None for missing ones, and all their samples in one flat array.
+
+    """
+    try:
+        # Repeated results, the usual case, are converted without a Python
+        # operation per result. Anything else fails, and is normalised.
+        lengths = np.array(map(len, column), dtype=int)
+        samples = np.fromiter(chain.from_iterable(column), dtype=float)
+    except (TypeError, ValueError):
+        column = [[] if value is None else result_samples(value)
+                  for value in column]
+        lengths = np.array(map(len, column), dtype=int)
+        samples = np.fromiter(chain.from_iterable(column), dtype=float)
+    return lengths, samples
+
+
+def _column_reduce(column, reduce):
+    """
+    Returns the minimum or maximum, by the ``reduce`` builtin, of each
+    result in a column of results, with None for missing ones, as an array
+    with NaN for missing results.
+
+    """
+    try:
+        return np.array(map(reduce, column), dtype=float)
+    except (TypeError, ValueError):
+        column = [[] if value is None else result_samples(value)
+                  for value in column]
+        return np.array([reduce(value) if value else np.nan
+                         for value in column], dtype=float)
+
+
+class ResultsArray(object):
+    """
+    Metric results as a commit x metric x sample array.
+
+    Results with fewer samples than others, and missing results, are padded
+    with NaN, so statistics are computed for all commits and metrics at
+    once, ignoring the padding.
+
+    """
+    def __init__(self, commits, metrics, values):
+        """
+        Args:
+
+        * commits:
+            The commits, in order of the first axis of ``values``.
+        * metrics:
+            The metric IDs, in order of the second axis of ``values``.
+        * values:
+            The samples of each result, as a NaN-padded 3-D array.
+
+        """
+        self.commits = list(commits)
+        self.metrics = list(metrics)
+        self.values = values
+
+    @classmethod
+    def from_results(cls, results, commits=None, metrics=None,
+                     statistic=None):
+        """
+        Build the array of a dictionary of results loaded from a Tehuti
+        metrics JSON file.
+
+        Kwargs:
+
+        * commits:
+            The commits to include. Defaults to all commits in the results.
+        * metrics:
+            The metrics to include. Defaults to every metric with results
+            for any of the commits.
+        * statistic:
+            'min' or 'max' to keep just that sample of each result, which is
+            much cheaper than building the array of all the samples.
+
+        """
+        if commits is None:
+            commits = results.keys()
+        if metrics is None:
+            metrics = sorted(set(key for commit in commits
+                                 for key in results[commit]) - METADATA_KEYS)
+        entries = [results[commit] for commit in commits]
+        if statistic is not None:
+            reduce = {'min': min, 'max': max}[statistic]
+            values = np.empty((len(commits), len(metrics), 1))
+            for j, metric in enumerate(metrics):
+                values[:, j, 0] = _column_reduce(
+                    [entry.get(metric) for entry in entries], reduce)
+            return cls(commits, metrics, values)
+        columns = [_column_samples([entry.get(metric) for entry in entries])
+                   for metric in metrics]
+        depth = max([1] + [lengths.max() for lengths, _ in columns
+                           if len(lengths)])
+        values = np.full((len(commits), len(metrics), depth), np.nan)
+        for j, (lengths, samples) in enumerate(columns):
+            if len(lengths) and lengths.min() == lengths.max():
+                values[:, j, :lengths[0]] = samples.reshape(len(lengths),
+                                                            lengths[0])
+            else:
+                starts = np.cumsum(lengths) - lengths
+                rows = np.repeat(np.arange(len(lengths)), lengths)
+                values[rows, j, np.arange(len(samples)) -
+                       np.repeat(starts, lengths)] = samples
+        return cls(commits, metrics, values)
+
+    def select(self, commits=None, metrics=None):
+        """
+        Returns the array of a subset of the commits and metrics, in the
+        given orders. Unknown commits or metrics raise a KeyError.
+
+        """
+        if commits is None:
+            commits = self.commits
+        if metrics is None:
+            metrics = self.metrics
+        rows = {commit: i for i, commit in enumerate(self.commits)}
+        columns = {metric: j for j, metric in enumerate(self.metrics)}
+        # A single indexing operation, so only one copy is made.
+        values = self.values[np.ix_([rows[commit] for commit in commits],
+                                    [columns[metric] for metric in metrics])]
+        return ResultsArray(commits, metrics, values)
+
+    @property
+    def present(self):
+        """A commit x metric boolean array of which results exist."""
+        return ~np.isnan(self.values).all(axis=2)
+
+    def common_metrics(self):
+        """Returns the metrics that have results for every commit."""
+        return [metric for metric, common in
+                zip(self.metrics, self.present.all(axis=0)) if common]
+
+    def reduce(self, statistic='min'):
+        """
+        Reduce the samples of each result to a single value.
+
+        Args:
+
+        * statistic:
+            One of 'min', 'max', 'mean' or 'median', or a number to compute
+            that percentile.
+
+        Returns:
+            A commit x metric array, with NaN for missing results.
+
+        """
+        with warnings.catch_warnings():
+            # Missing results are all-NaN slices.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            if isinstance(statistic, (int, float)):
+                return np.nanpercentile(self.values, statistic, axis=2)
+            reduce = {'min': np.nanmin, 'max': np.nanmax,
+                      'mean': np.nanmean, 'median': np.nanmedian}[statistic]
+            return reduce(self.values, axis=2)
+
+    def samples(self, commit_index, metric_index):
+        """Returns the samples of one result, without padding."""
+        values = self.values[commit_index, metric_index]
+        return values[~np.isnan(values)]
+
+
+def binned_kde(values, points=100):
+    """
+    Gaussian kernel density estimates of many sets of samples at once.
+
+    Each set of samples is linearly binned onto a grid of ``points`` points
+    spanning its range, then all the binned sets are convolved with their
+    Gaussian kernels together, by FFT. Every set uses Scott's rule for its
+    bandwidth, as :class:`scipy.stats.gaussian_kde` does.
+
+    Args:
+
+    * values:
+        A 2-D array with one set of samples per row, padded with NaN.
+
+    Kwargs:
+
+    * points:
+        The number of points at which to evaluate each density.
+
+    Returns:
+        The grids of points, and the densities at them, as two arrays of
+        shape ``(len(values), points)``. The densities of sets with fewer
+        than two distinct values are NaN.
+
+    """
+    values = np.asarray(values, dtype=float)
+    rows = len(values)
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=1)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low = np.nanmin(values, axis=1)
+        high = np.nanmax(values, axis=1)
+        std = np.nanstd(values, axis=1, ddof=1)
+        usable = (count >= 2) & (std > 0)
+    grids = low[:, None] + (high - low)[:, None] * np.linspace(0, 1, points)
+    # Give the sets that can't be estimated harmless values, so that no
+    # warnings are raised for them, and set their densities to NaN at the
+    # end.
+    step = np.where(usable, (high - low) / (points - 1), 1)
+    usable_count = np.where(usable, count, 1)
+    bandwidth = np.where(usable, std, 1) * usable_count ** -0.2
+
+    # Linear binning: split each sample between its two nearest points.
+    position = np.where(valid, (values - low[:, None]) / step[:, None], 0)
+    lower = np.clip(np.floor(position).astype(int), 0, points - 2)
+    upper_weight = position - lower
+    lower += np.arange(rows)[:, None] * points
+    include = valid & usable[:, None]
+    binned = (np.bincount(lower[include], 1 - upper_weight[include],
+                          rows * points) +
+              np.bincount(lower[include] + 1, upper_weight[include],
+                          rows * points)).reshape(rows, points)
+
+    # Zero pad to twice the grid so that the convolution doesn't wrap.
+    size = 2 * points
+    offsets = np.arange(size)
+    offsets = np.where(offsets < points, offsets, offsets - size)
+    kernels = np.exp(-0.5 * (offsets / (bandwidth / step)[:, None]) ** 2)
+    densities = np.fft.irfft(np.fft.rfft(binned, size, axis=1) *
+                             np.fft.rfft(kernels, axis=1), size, axis=1)
+    densities = np.clip(densities[:, :points], 0, None)
+    densities /= (usable_count * bandwidth * np.sqrt(2 * np.pi))[:, None]
+    densities[~usable] = np.nan
+    return grids, densities
+
+
+def lttb(values, size):
+    """
+    Downsample a series with the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last values are kept, and the values between them are
+    split into ``size - 2`` buckets. From each bucket the value forming the
+    largest triangle with the value kept from the previous bucket and the
+    mean of the next bucket is kept, which preserves the visual shape of the
+    series.
+
+    Args:
+
+    * values:
+        The series, equally spaced. NaN marks missing values.
+    * size:
+        The number of values to keep.
+
+    Returns:
+        The sorted indices of the values kept.
+
+    """
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if size >= n or size < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, size - 1).astype(int)
+    edges = np.append(edges, n)
+    kept = [0]
+    with warnings.catch_warnings():
+        # The next bucket may hold only missing values.
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for start, stop, next_stop in zip(edges[:-2], edges[1:-1],
+                                          edges[2:]):
+            previous = kept[-1]
+            next_x = (stop + next_stop - 1) / 2.0
+            next_y = np.nanmean(values[stop:next_stop])
+            x = np.arange(start, stop)
+            areas = np.abs((previous - next_x) *
+                           (values[start:stop] - values[previous]) -
+                           (previous - x) * (next_y - values[previous]))
+            kept.append(start + np.where(np.isnan(areas), -1, areas).argmax())
+    kept.append(n - 1)
+    return np.array(kept)
+
+
+def level_of_detail(series, size):
+    """
+    Choose which points of one or more series, sharing an x axis, to plot.
+
+    Each series is downsampled by :func:`lttb`, and its extremes are always
+    kept. So are the points either side of its largest change points (see
+    :func:`tehuti.change_points`), up to `CHANGE_POINT_FRACTION` of ``size``
+    of them, so that noisy series are still downsampled.
+
+    Args:
+
+    * series:
+        A 2-D array with one series per row. NaN marks missing values.
+    * size:
+        The approximate number of points to keep from each series.
+
+    Returns:
+        The sorted indices of the points to plot.
+
+    """
+    series = np.atleast_2d(np.asarray(series, dtype=float))
+    kept = [lttb(row, size) for row in series]
+    changes = {}
+    for row, index, before, after in change_points(series):
+        changes.setdefault(row, []).append((abs(after - before), index))
+    limit = max(1, int(size * CHANGE_POINT_FRACTION))
+    for row_changes in changes.values():
+        for _, index in sorted(row_changes, reverse=True)[:limit]:
+            kept.append([index - 1, index])
+    valid = ~np.isnan(series).all(axis=1)
+    filled = series[valid]
+    if len(filled):
+        kept.append(np.nanargmin(filled, axis=1))
+        kept.append(np.nanargmax(filled, axis=1))
+    return np.unique(np.concatenate(kept).astype(int))
 
 
 class Visualiser(object):
     """The base class for visualiser states."""
 
-    def _select_data_common(self, commit, metrics):
+    def _select_commits_metrics(self, commit, metrics):
+        """
+        Resolve the commits and metrics to select. If no metrics are given,
+        only metrics that show up in all the selected commits are chosen.
+
+        """
+        results = self.vis.results
         if commit is None:
-            commits = self.vis.results.keys()
+            commits = results.keys()
         elif isinstance(commit, basestring):
-            commits = list(commit)
+            commits = [commit]
         else:
-            commits = commit
+            commits = list(commit)
         if metrics is None:
-            # Only choose metrics that show up in all runs.
-            keys = None
-            for metrics in self.vis.results.values():
-                if keys is None:
-                    keys = set(metrics.keys()) - {'name'}
-                else:
-                    metrics_keys = metrics.keys()
-                    common = set(metrics_keys) & keys
-                    keys = common
-            metrics = list(keys)
+            common = set(results[commits[0]]) if commits else set()
+            for commit in commits[1:]:
+                common.intersection_update(results[commit])
+            metrics = sorted(common - METADATA_KEYS)
         return commits, metrics
 
+    def _select_data_common(self, commit, metrics, statistic=None):
+        """
+        Select the results of commits and metrics as a
+        :class:`ResultsArray`, built from just those results. If no metrics
+        are given, only metrics that show up in all the selected commits are
+        chosen. A ``statistic`` keeps just that sample of each result, as
+        for :meth:`ResultsArray.from_results`.
+
+        """
+        commits, metrics = self._select_commits_metrics(commit, metrics)
+        return ResultsArray.from_results(self.vis.results, commits, metrics,
+                                         statistic)
+
+    def _level_of_detail(self, *series):
+        """
+        Choose the commits to plot, and the commits to label, for one or more
+        series plotted against the same commits.
+
+        All commits are plotted and labelled, unless there are more than the
+        visualiser's `lod_threshold` of them. Then the series are downsampled
+        to about that many points by :func:`level_of_detail`, and only
+        `MAX_TICK_LABELS` evenly spaced commits are labelled.
+
+        Returns:
+            The indices of the commits to plot and to label.
+
+        """
+        count = len(series[0])
+        threshold = self.vis.lod_threshold
+        if not threshold or count <= threshold:
+            indices = np.arange(count)
+            return indices, indices
+        plotted = level_of_detail(series, threshold)
+        labelled = np.unique(np.linspace(0, count - 1,
+                                         MAX_TICK_LABELS).round().astype(int))
+        return plotted, labelled
+
+    def _set_commit_ticks(self, ax, commits, labelled):
+        """
+        Label the commits with the given indices along the x axis of `ax`,
+        where commit ``i`` is plotted at ``i + 1``.
+
+        """
+        # Pad both ends of the axis with unlabelled ticks.
+        ax.set_xticks([0] + [i + 1 for i in labelled] + [len(commits) + 1])
+        ax.set_xticklabels([''] + [shorten_sha(commits[i]) for i in labelled],
+                           rotation=30)
+
     def select_data(self, commit, metrics):
         raise NotImplemented
 
@@ -109,16 +491,12 @@ class VaryRepoCommit(Visualiser):
             The selected data formatted for plotting.
 
         """
-        commits, metrics = self._select_data_common(commits, metrics)
+        array = self._select_data_common(commits, metrics, 'min')
+        values = array.reduce('min')
         data = {}
-        for metric in metrics:
-            data[metric] = {commit: 0 for commit in commits}
-            for commit in commits:
-                result = self.vis.results[commit][metric]
-                if isinstance(result, list):
-                    data[metric][commit] = min(result)
-                else:
-                    data[metric][commit] = result
+        for j, metric in enumerate(array.metrics):
+            data[metric] = OrderedDict(zip(array.commits,
+                                           values[:, j].tolist()))
         return data
 
     def _plot_single_axis(self):
@@ -146,7 +524,7 @@ class VaryRepoCommit(Visualiser):
         ax.set_ylabel(metric_unit)
         ax.set_title('{} metrics'.format(metric_unit.split(' ')[0]))
         ax.legend()
-        plt.show()
+        self.vis.show()
 
     def _plot(self):
         """
@@ -155,19 +533,17 @@ class VaryRepoCommit(Visualiser):
         """
         plot_data = self.vis.plot_data
         for name, results in plot_data.iteritems():
-            # Pad the start of the labels list.
-            x_labels = ['']
-            x_labels.extend([shorten_sha(k) for k in results.keys()])
-            x_points = range(0, len(x_labels)+1)
-            values = results.values()
+            commits = results.keys()
+            values = np.array(results.values(), dtype=float)
+            x_points = np.arange(1, len(commits) + 1)
+            plotted, labelled = self._level_of_detail(values)
 
             ax = plt.axes()
             ax.set_title(name)
-            ax.plot(x_points[1:-1], values)
-            ax.set_xticks(x_points)
-            ax.set_xticklabels(x_labels, rotation=30)
+            ax.plot(x_points[plotted], values[plotted])
+            self._set_commit_ticks(ax, commits, labelled)
             ax.set_ylabel(Y_AXIS_LABELS[name.split('-')[0]])
-            plt.show()
+            self.vis.show()
 
     def plot(self, alternate_plot):
         """
@@ -220,6 +596,24 @@ class Violin(Visualiser):
 
         """
         self.vis = vis
+        # Violin densities, keyed by a hash of the samples.
+        self._densities = {}
+
+    def densities(self, samples):
+        """
+        The violin densities of several sets of samples, from
+        :func:`binned_kde`. Densities are cached by the hash of the samples,
+        so replotting the same data doesn't recompute them.
+
+        """
+        values = np.full((len(samples), max(len(s) for s in samples)),
+                         np.nan)
+        for i, s in enumerate(samples):
+            values[i, :len(s)] = s
+        key = hashlib.sha1(values.tobytes()).hexdigest()
+        if key not in self._densities:
+            self._densities[key] = binned_kde(values)
+        return self._densities[key]
 
     def select_data(self, commits, metrics):
         """
@@ -245,16 +639,16 @@ class Violin(Visualiser):
             The selected data formatted for plotting.
 
         """
-        commits, metrics = self._select_data_common(commits, metrics)
+        # The samples are plotted as they are, so they are taken straight
+        # from the results rather than through a ResultsArray.
+        commits, metrics = self._select_commits_metrics(commits, metrics)
+        results = self.vis.results
         data = {}
         for metric in metrics:
-            data[metric] = {commit: 0 for commit in commits}
-            for commit in commits:
-                result = self.vis.results[commit][metric]
-                if not isinstance(result, list):
-                    data[metric][commit] = [result]
-                else:
-                    data[metric][commit] = result
+            column = [results[commit].get(metric, []) for commit in commits]
+            data[metric] = OrderedDict(zip(commits, [
+                value if isinstance(value, list) else result_samples(value)
+                for value in column]))
         return data
 
     # http://pyinsci.blogspot.co.uk/2009/09/violin-plot-with-matplotlib.html
@@ -279,17 +673,14 @@ class Violin(Visualiser):
             x_points = range(len(results.keys()))
             dist = max(x_points) - min(x_points)
             w = min(0.15 * max(dist, 1.0), 0.5)
-            for d, p in zip(results.values(), x_points):
+            # Violin profiles (density curves) of all commits at once.
+            grids, densities = self.densities(results.values())
+            for d, p, x, v in zip(results.values(), x_points, grids,
+                                  densities):
                 # If we only have a single value, plot a line instead
-                try:
-                    k = gaussian_kde(d)  # Calculate the kernel density.
-                except ValueError:
+                if np.isnan(v).all():
                     ax.hlines(d, p-w, p+w)
                 else:
-                    k_min = k.dataset.min()  # Lower bound of violin.
-                    k_max = k.dataset.max()  # Upper bound of violin.
-                    x = np.arange(k_min, k_max, (k_max-k_min)/100.)
-                    v = k.evaluate(x)  # Violin profile (density curve).
                     v = v / v.max() * w  # Scale violin to available space.
                     ax.fill_betweenx(x, p, v+p, facecolor='y', alpha=0.3)
                     ax.fill_betweenx(x, p, -v+p, facecolor='y', alpha=0.3)
@@ -299,7 +690,7 @@ class Violin(Visualiser):
             ax.set_xticks(x_points)
             ax.set_xticklabels(x_labels, rotation=30)
             ax.set_title(name)
-            plt.show()
+            self.vis.show()
 
 
 class ManyBenchmarks(Visualiser):
@@ -348,28 +739,26 @@ class ManyBenchmarks(Visualiser):
             The selected data formatted for plotting.
 
         """
-        commits, metrics = self._select_data_common(commits, metrics)
+        array = self._select_data_common(commits, metrics, 'min')
         # Get unique benchmarks and metrics.
-        benchmarks = {}.fromkeys([m.split('-')[0] for m in metrics]).keys()
-        metrics = {}.fromkeys([m.split('-', 1)[1] for m in metrics]).keys()
+        benchmarks = {}.fromkeys([m.split('-')[0]
+                                  for m in array.metrics]).keys()
+        metrics = {}.fromkeys([m.split('-', 1)[1]
+                               for m in array.metrics]).keys()
         if len(benchmarks) > 2:
             msg = ('Expected two benchmarks to plot together but got {}. '
                    'They were: {}.')
             raise ValueError(msg.format(len(benchmarks),
                                         ', '.join(benchmarks)))
+        # Reconstruct original metric names: 'b-metric'.
+        array = array.select(metrics=[b + '-' + metric for metric in metrics
+                                      for b in benchmarks])
+        values = array.reduce('min')
         data = {}
-        for metric in metrics:
-            data[metric] = {b: None for b in benchmarks}
-            for b in benchmarks:
-                data[metric][b] = {commit: None for commit in commits}
-                for commit in commits:
-                    # Reconstruct original metric name: 'b-metric'.
-                    full_metric = b + '-' + metric
-                    result = self.vis.results[commit][full_metric]
-                    if isinstance(result, list):
-                        data[metric][b][commit] = min(result)
-                    else:
-                        data[metric][b][commit] = result
+        for j, full_metric in enumerate(array.metrics):
+            b, metric = full_metric.split('-', 1)
+            data.setdefault(metric, {})[b] = OrderedDict(
+                zip(array.commits, values[:, j].tolist()))
         return data
 
     def _plot_single_axis(self):
@@ -410,7 +799,7 @@ class ManyBenchmarks(Visualiser):
         ax1.set_title('Multi metrics')
         labels = [plot.get_label() for plot in plots]
         plt.legend(plots, labels)
-        plt.show()
+        self.vis.show()
 
     def _plot(self):
         """
@@ -421,29 +810,29 @@ class ManyBenchmarks(Visualiser):
         for name, results in plot_data.iteritems():
             b1 = results[results.keys()[0]]
             b2 = results[results.keys()[1]]
-            x_labels = ['']
-            x_labels.extend([shorten_sha(k) for k in b1.keys()])
-            x_points = range(0, len(x_labels)+1)
-            b1_values = b1.values()
-            b2_values = b2.values()
+            commits = b1.keys()
+            x_points = np.arange(1, len(commits) + 1)
+            b1_values = np.array(b1.values(), dtype=float)
+            b2_values = np.array(b2.values(), dtype=float)
+            plotted, labelled = self._level_of_detail(b1_values, b2_values)
 
             ax1 = plt.axes()
             ax1.set_title(name)
             l1 = Y_AXIS_LABELS[results.keys()[0]].split(' ')[0]
-            p = ax1.plot(x_points[1:-1], b1_values, label=l1)
-            ax1.set_xticks(x_points)
-            ax1.set_xticklabels(x_labels, rotation=30)
+            p = ax1.plot(x_points[plotted], b1_values[plotted], label=l1)
+            self._set_commit_ticks(ax1, commits, labelled)
             ax1.set_ylabel(Y_AXIS_LABELS[results.keys()[0]])
 
             ax2 = ax1.twinx()
             l2 = Y_AXIS_LABELS[results.keys()[1]].split(' ')[0]
-            p2 = ax2.plot(x_points[1:-1], b2_values, '--', label=l2)
+            p2 = ax2.plot(x_points[plotted], b2_values[plotted], '--',
+                          label=l2)
             ax2.set_ylabel(Y_AXIS_LABELS[results.keys()[1]])
 
             plots = p + p2
             labels = [plot.get_label() for plot in plots]
             plt.legend(plots, labels)
-            plt.show()
+            self.vis.show()
 
     def plot(self, alternate_plot):
         """
@@ -513,26 +902,23 @@ class VarySetup(Visualiser):
             The selected data formatted for plotting.
 
         """
-        commits, metrics = self._select_data_common(commits, metrics)
+        array = self._select_data_common(commits, metrics, 'min')
         # Get unique benchmarks.
-        benchmarks = {}.fromkeys([m.split('-')[0] for m in metrics]).keys()
+        benchmarks = {}.fromkeys([m.split('-')[0]
+                                  for m in array.metrics]).keys()
         # We want all metrics, but without the leading benchmark reference.
-        metrics = [m.split('-', 1)[1] for m in metrics]
+        metrics = [m.split('-', 1)[1] for m in array.metrics]
         data = {}
 
         for b in benchmarks:
-            data[b] = {commit: None for commit in commits}
-            for commit in commits:
+            # Reconstruct original metric names: 'b-metric'.
+            values = array.select(
+                metrics=[b + '-' + metric for metric in metrics]).reduce('min')
+            data[b] = OrderedDict()
+            for i, commit in enumerate(array.commits):
                 # We need to retain the order we receive the metrics in.
-                data[b][commit] = OrderedDict.fromkeys(metrics)
-                for metric in metrics:
-                    # Reconstruct original metric name: 'b-metric'.
-                    full_metric = b + '-' + metric
-                    result = self.vis.results[commit][full_metric]
-                    if isinstance(result, list):
-                        data[b][commit][metric] = min(result)
-                    else:
-                        data[b][commit][metric] = result
+                data[b][commit] = OrderedDict(zip(metrics,
+                                                  values[i].tolist()))
         return data
 
     def _plot_single_axis(self):
@@ -560,7 +946,7 @@ class VarySetup(Visualiser):
         ax.set_ylabel(metric_unit)
         ax.set_title('{} metrics'.format(metric_unit.split(' ')[0]))
         ax.legend()
-        plt.show()
+        self.vis.show()
 
     def _plot(self):
         """
@@ -586,7 +972,7 @@ class VarySetup(Visualiser):
                 ax.set_xticks(x_points)
                 ax.set_xticklabels(x_labels, rotation=30)
                 ax.set_ylabel(Y_AXIS_LABELS[name])
-                plt.show()
+                self.vis.show()
 
     def plot(self, alternate_plot):
         """